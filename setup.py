@@ -32,6 +32,7 @@ setup(name='sphinxpapyrus-docxbuilder',
       url='https://github.com/nakandev/sphinxpapyrus-docxbuilder',
       license='MIT',
       install_requires=['python-docx'],
+      extras_require={'images': ['Pillow']},
       platforms='any',
       packages=find_packages(),
       package_data={'sphinxpapyrus': ['docxbuilder/templates/*']},
@@ -11,6 +11,7 @@
 
 import os
 from .builder import DocxBuilder
+from .images import DocxImageConverter
 
 __version__ = '0.1.0'
 
@@ -23,9 +24,22 @@ def setup(app):
     app.add_config_value('docx_coreproperties', {}, 'env')
     app.add_config_value('docx_pagebreak_level', None, 'env')
     app.add_config_value('docx_imagetable_align', None, 'env')
+    app.add_config_value('docx_table_layout', 'auto', 'env')
+    app.add_config_value('docx_fragment_cache', False, 'env')
+    app.add_config_value('docx_backend', 'python-docx', 'env')
+    app.add_config_value('docx_streaming', False, 'env')
+    app.add_config_value('docx_compresslevel', None, 'env')
+    app.add_config_value('docx_reproducible', False, 'env')
+    app.add_config_value('docx_image_threads', 4, 'env')
+    app.add_config_value('docx_image_max_dpi', None, 'env')
+    app.add_config_value('docx_image_jpeg_quality', 85, 'env')
+    app.add_config_value('docx_image_convert_dpi', 150, 'env')
+    app.add_config_value('docx_doctree_cache_size', 256, 'env')
+    app.add_config_value('docx_highlight_max_size', 50000, 'env')
+    app.add_post_transform(DocxImageConverter)
 
     return {
         'version': 'builtin',
-        'parallel_read_safe': False,
-        'parallel_write_safe': False,
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
     }
\ No newline at end of file
@@ -10,161 +10,488 @@
 """
 
 import codecs
+import hashlib
+import json
+import os
 from os import path
 
 from docutils import nodes
 from docutils.io import StringOutput
 
+from sphinx import addnodes
 from sphinx.builders import Builder
 from sphinx.util import logging
 from sphinx.util.osutil import ensuredir, os_path
 from sphinx.util.console import bold, darkgreen, brown
-from .writer import DocxWriter, DocxTranslator
+from sphinx.util.parallel import ParallelTasks
+from .cache import DiskCache, DoctreeCache, file_digest, template_cache
+from .highlighting import Highlighter
+from .omml import MathConverter
+from .images import (VECTOR_IMAGE_EXTS, ImageOptimizer, MediaRegistry, PILImage,
+                     render_images)
+from .writer import DocxWriter, DocxTranslator, bookmark_name, get_style_path
 
 if False:
     # For type annotation
-    from typing import Any, Dict, Iterator, Set  # NOQA
+    from typing import Any, Callable, Dict, Iterable, Iterator, List, Sequence, Set, Tuple  # NOQA
     from docutils import nodes  # NOQA
     from sphinx.application import Sphinx  # NOQA
 
 logger = logging.getLogger(__name__)
 
+BUILDINFO_FILENAME = '.docxbuildinfo'
+
 def inline_all_toctrees(builder, docnameset, docname, tree, colorfunc, traversed):
-    # type: (Builder, Set[unicode], unicode, nodes.Node, Callable, nodes.Node) -> nodes.Node
+    # type: (Builder, Set[unicode], unicode, nodes.Node, Callable, Iterable[unicode]) -> nodes.Node
     """Inline all toctrees in the *tree*.
 
     Record all docnames in *docnameset*, and output docnames with *colorfunc*.
+    Documents are included depth-first, each once; docnames in *traversed*
+    are skipped. *tree* is modified in place and the included doctrees are
+    taken resolved from the builder's doctree cache, so nothing is
+    deep-copied.
     """
     from six import text_type
-    from docutils import nodes
-    from sphinx import addnodes
-
-    tree = tree.deepcopy()
-    for toctreenode in tree.traverse(addnodes.toctree):
-        newnodes = []
-        includefiles = map(text_type, toctreenode['includefiles'])
-        for includefile in includefiles:
-            if includefile not in traversed:
-                try:
-                    traversed.append(includefile)
-                    logger.info(colorfunc(includefile) + " ", nonl=1)
-                    subtree = inline_all_toctrees(builder, docnameset, includefile,
-                                                  builder.env.get_doctree(includefile),
-                                                  colorfunc, traversed)
-                    docnameset.add(includefile)
-                except Exception:
-                    logger.warning('toctree contains ref to nonexisting file %r',
-                                   includefile, location=docname)
-                else:
-                    sof = addnodes.start_of_file(docname=includefile)
-                    sof.children = subtree.children
-                    for sectionnode in sof.traverse(nodes.section):
-                        if 'docname' not in sectionnode:
-                            sectionnode['docname'] = includefile
-                    newnodes.append(sof)
-        toctreenode.parent['numbered'] = toctreenode['numbered']
-        toctreenode.parent.replace(toctreenode, newnodes)
+
+    traversed = set(traversed)
+    stack = []  # type: List[Tuple]
+
+    def push_toctrees(tree, docname):
+        # type: (nodes.Node, unicode) -> None
+        # popped in document order: the files of a toctree, then its replacement
+        for toctreenode in reversed(list(tree.traverse(addnodes.toctree))):
+            newnodes = []  # type: List[nodes.Node]
+            stack.append((toctreenode, None, newnodes))
+            for includefile in reversed(list(map(text_type, toctreenode['includefiles']))):
+                stack.append((toctreenode, includefile, newnodes))
+
+    push_toctrees(tree, docname)
+    while stack:
+        toctreenode, includefile, newnodes = stack.pop()
+        if includefile is None:
+            toctreenode.parent['numbered'] = toctreenode['numbered']
+            toctreenode.parent.replace(toctreenode, newnodes)
+            continue
+        if includefile in traversed:
+            continue
+        traversed.add(includefile)
+        try:
+            logger.info(colorfunc(includefile) + " ", nonl=1)
+            subtree = builder.doctree_cache.get(builder.env, includefile,
+                                                builder.resolve_doctree)
+        except Exception:
+            logger.warning('toctree contains ref to nonexisting file %r',
+                           includefile, location=toctreenode.get('parent'))
+            continue
+        docnameset.add(includefile)
+        for sectionnode in subtree.traverse(nodes.section):
+            if 'docname' not in sectionnode:
+                sectionnode['docname'] = includefile
+        sof = addnodes.start_of_file(docname=includefile)
+        sof.children = subtree.children
+        newnodes.append(sof)
+        push_toctrees(subtree, includefile)
     return tree
 
 class DocxBuilder(Builder):
     name = 'docx'
     format = 'docx'
     out_suffix = '.docx'
-    allow_parallel = False
+    allow_parallel = True
+    supported_image_types = ['image/png', 'image/gif', 'image/jpeg', 'image/bmp',
+                             'image/tiff']
     default_translator_class = DocxTranslator
 
     current_docname = None  # type: unicode
 
+    # config values which do not change the contents of the output files
+    config_ignored = ('docx_documents', 'docx_coreproperties', 'docx_image_threads',
+                      'docx_doctree_cache_size')
+
     def init(self):
         # type: () -> None
-        pass
+        self.buildinfo = self.load_buildinfo()
+        self.fignum_prefixes = {}  # type: Dict[Tuple[unicode, unicode], unicode]
+        self.bookmarks = {}  # type: Dict[Tuple[unicode, unicode], unicode]
+        self.doctree_cache = DoctreeCache(int(self.config.docx_doctree_cache_size) << 20)
+        self.fragment_cache = None
+        if self.config.docx_fragment_cache:
+            self.fragment_cache = DiskCache(path.join(self.doctreedir, 'docx_fragments'))
+        self.fragment_digest = None
+        self.fragment_hits = self.fragment_misses = 0
+        self.merged_runs = self.merged_bytes = 0
+        self.media = MediaRegistry()
+        self.highlighter = None
+        if int(self.config.docx_highlight_max_size) > 0:
+            self.highlighter = Highlighter(
+                self.config, DiskCache(path.join(self.doctreedir, 'docx_highlight')),
+                int(self.config.docx_highlight_max_size), self.app.parallel)
+        self.math_converter = MathConverter(DiskCache(path.join(self.doctreedir, 'docx_math')))
+        self.image_cache = DiskCache(path.join(self.doctreedir, 'docx_images'))
+        self.image_optimizer = None
+        if self.config.docx_image_max_dpi:
+            if PILImage is None:
+                logger.warning('docx_image_max_dpi needs Pillow, images are not downsampled')
+            else:
+                self.image_optimizer = ImageOptimizer(
+                    self.image_cache, self.config.docx_image_max_dpi, self.config.docx_image_jpeg_quality,
+                    int(self.config.docx_image_threads))
+
+    def load_buildinfo(self):
+        # type: () -> Dict[unicode, Dict]
+        try:
+            with open(path.join(self.outdir, BUILDINFO_FILENAME)) as f:
+                buildinfo = json.load(f)
+            if not isinstance(buildinfo, dict):
+                raise ValueError('unexpected build info format')
+            return buildinfo
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def dump_buildinfo(self):
+        # type: () -> None
+        try:
+            with open(path.join(self.outdir, BUILDINFO_FILENAME), 'w') as f:
+                json.dump(self.buildinfo, f, indent=1, sort_keys=True)
+        except (IOError, OSError) as err:
+            logger.warning('error writing file %s: %s', BUILDINFO_FILENAME, err)
+
+    def get_docx_documents(self):
+        # type: () -> List[Tuple[unicode, unicode, Dict]]
+        if self.config.docx_documents:
+            return self.config.docx_documents
+        else:
+            return [(self.config.master_doc, self.config.project,
+                     self.config.docx_coreproperties)]
+
+    def get_included_docnames(self, start):
+        # type: (unicode) -> List[unicode]
+        """Return *start* and all docnames reached from it through toctrees."""
+        docnames = [start]
+        seen = set(docnames)
+        for docname in docnames:
+            for includefile in self.env.toctree_includes.get(docname, []):
+                if includefile not in seen and includefile in self.env.all_docs:
+                    seen.add(includefile)
+                    docnames.append(includefile)
+        return docnames
+
+    def get_config_digest(self, coreproperties):
+        # type: (Dict) -> unicode
+        values = [('coreproperties', sorted(coreproperties.items()))]
+        for name in ('master_doc', 'numfig', 'numfig_format', 'language',
+                     'pygments_style', 'highlight_options'):
+            values.append((name, getattr(self.config, name)))
+        for name in sorted(self.config.values):
+            if name.startswith('docx_') and name not in self.config_ignored:
+                values.append((name, getattr(self.config, name)))
+        return hashlib.md5(repr(values).encode('utf-8')).hexdigest()
+
+    def get_fragment_digest(self):
+        # type: () -> unicode
+        """Return the part of the fragment cache keys shared by all chapters."""
+        if self.fragment_digest is None:
+            values = (self.get_config_digest({}), template_cache.digest(get_style_path(self)))
+            self.fragment_digest = hashlib.md5(repr(values).encode('utf-8')).hexdigest()
+        return self.fragment_digest
+
+    def get_dependencies(self, entry):
+        # type: (Tuple[unicode, unicode, Dict]) -> Dict[unicode, Any]
+        """Collect everything the output file of *entry* is built from."""
+        start, name, coreproperties = entry
+        docnames = self.get_included_docnames(start)
+        files = {}  # type: Dict[unicode, float]
+        for docname in docnames:
+            for dep in self.env.dependencies.get(docname, ()):
+                # newer Sphinx records path objects, which JSON cannot store
+                dep = str(dep)
+                deppath = path.join(self.srcdir, dep)
+                try:
+                    files[dep] = path.getmtime(deppath)
+                except (IOError, OSError):
+                    files[dep] = None
+        style_path = get_style_path(self)
+        try:
+            style = [style_path, path.getmtime(style_path), None]
+        except (IOError, OSError):
+            style = [style_path, None, None]
+        return {
+            'docnames': dict((docname, self.env.all_docs.get(docname))
+                             for docname in docnames),
+            'files': files,
+            'style': style,
+            'config': self.get_config_digest(coreproperties),
+        }
+
+    def get_outdated_reason(self, entry, deps, updated_docnames=()):
+        # type: (Tuple[unicode, unicode, Dict], Dict[unicode, Any], Set[unicode]) -> unicode
+        """Return why the output file of *entry* must be written, or None."""
+        start, name, coreproperties = entry
+        outfilename = path.join(self.outdir, os_path(name) + self.out_suffix)
+        if not path.isfile(outfilename):
+            return 'output file is missing'
+        old = self.buildinfo.get(name)
+        if not old:
+            return 'no previous build information'
+        if old.get('config') != deps['config']:
+            return 'configuration changed'
+        style_path, style_mtime, _ = deps['style']
+        old_style = old.get('style') or [None, None, None]
+        if old_style[0] != style_path:
+            return 'style file changed'
+        if old_style[1] != style_mtime:
+            try:
+                deps['style'][2] = template_cache.digest(style_path)
+            except (IOError, OSError):
+                return 'style file is missing'
+            if old_style[2] != deps['style'][2]:
+                return 'style file changed'
+        else:
+            deps['style'][2] = old_style[2]
+        docnames = deps['docnames']
+        if set(old.get('docnames', {})) != set(docnames):
+            return 'included documents changed'
+        changed = sorted(docname for docname in docnames
+                         if docname in updated_docnames or
+                         old['docnames'][docname] != docnames[docname])
+        if changed:
+            return 'documents changed: %s' % ', '.join(changed)
+        changed = sorted(dep for dep, mtime in deps['files'].items()
+                         if old.get('files', {}).get(dep) != mtime)
+        if changed:
+            return 'dependencies changed: %s' % ', '.join(changed)
+        return None
 
     def get_outdated_docs(self):
         # type: () -> Iterator[unicode]
-        return 'all documents'
+        # sources changed since the last read are found by the environment;
+        # report the outputs which are outdated for other reasons
+        for entry in self.get_docx_documents():
+            deps = self.get_dependencies(entry)
+            if self.get_outdated_reason(entry, deps):
+                for docname in deps['docnames']:
+                    yield docname
 
     def get_target_uri(self, docname, typ=None):
         # type: (unicode, unicode) -> unicode
-        return ''
-
-    def fix_refuris(self, tree):
-        # type: (nodes.Node) -> None
-        # fix refuris with double anchor
-        fname = self.config.master_doc + self.out_suffix
-        for refnode in tree.traverse(nodes.reference):
-            if 'refuri' not in refnode:
-                continue
-            refuri = refnode['refuri']
-            hashindex = refuri.find('#')
-            if hashindex < 0:
-                continue
-            hashindex = refuri.find('#', hashindex + 1)
-            if hashindex >= 0:
-                refnode['refuri'] = fname + refuri[hashindex:]
-
-    def prepare_writing(self, docnames):
-        # type: (Set[unicode]) -> None
-        self.writer = DocxWriter(self)
+        # '%docname#id' references are resolved through self.bookmarks
+        return '%' + docname
+
+    def get_relative_uri(self, from_, to, typ=None):
+        # type: (unicode, unicode, unicode) -> unicode
+        # the target URIs are not paths, so they must not be made relative
+        return self.get_target_uri(to, typ)
+
+    def index_bookmarks(self, tree):
+        # type: (nodes.Node) -> Dict[Tuple[unicode, unicode], unicode]
+        """Return the bookmark names of all ids of the assembled *tree*.
+
+        Keys are ``(docname, id)``; ``(docname, '')`` names the first target
+        of each document, which references to the document point to.
+        """
+        bookmarks = {}  # type: Dict[Tuple[unicode, unicode], unicode]
+        stack = [(tree, tree['docname'])]
+        while stack:
+            node, docname = stack.pop()
+            if isinstance(node, addnodes.start_of_file):
+                docname = node['docname']
+            for id in node['ids']:
+                name = bookmark_name(docname, id)
+                bookmarks.setdefault((docname, id), name)
+                bookmarks.setdefault((docname, ''), name)
+            stack.extend((child, docname) for child in reversed(node.children)
+                         if isinstance(child, nodes.Element))
+        return bookmarks
+
+    def prepare_writing(self, docnames, coreproperties=None):
+        # type: (Set[unicode], Dict) -> None
+        self.writer = DocxWriter(self, coreproperties)
 
     def assemble_doctree(self, start=None):
         # type: () -> nodes.Node
         master = start if start else self.config.master_doc
-        tree = self.env.get_doctree(master)
+        tree = self.doctree_cache.get(self.env, master, self.resolve_doctree)
         tree = inline_all_toctrees(self, set(), master, tree, darkgreen, [master])
         tree['docname'] = master
-        self.env.resolve_references(tree, master, self)
-        self.fix_refuris(tree)
+        self.bookmarks = self.index_bookmarks(tree)
         return tree
 
-    def assemble_toc_fignumbers(self):
-        new_fignumbers = {}  # type: Dict[unicode, Dict[unicode, Tuple[int, ...]]]
+    def resolve_doctree(self, doctree, docname):
+        # type: (nodes.document, unicode) -> None
+        """Resolve the references and images of the doctree of *docname*.
+
+        Documents are resolved one by one, so the results are cached and
+        shared by all docx_documents entries which include them.
+        """
+        self.env.resolve_references(doctree, docname, self)
+        self.post_process_images(doctree)
+
+    def assemble_fignum_prefixes(self):
+        # type: () -> Dict[Tuple[unicode, unicode], unicode]
+        """Return the caption prefixes (e.g. 'Fig. 1.2') by (docname, node id).
+
+        The numbers are the same for every docx_documents entry, so they are
+        formatted once per build. Figure types without a numfig_format are
+        left out.
+        """
+        prefixes = {}  # type: Dict[Tuple[unicode, unicode], unicode]
+        if not self.config.numfig:
+            return prefixes
         # {u'foo': {'figure': {'id2': (2,), 'id1': (1,)}}, u'bar': {'figure': {'id1': (3,)}}}
         for docname, fignumlist in self.env.toc_fignumbers.items():
             for figtype, fignums in fignumlist.items():
-                alias = "%s/%s" % (docname, figtype)
-                new_fignumbers.setdefault(alias, {})
+                format = self.config.numfig_format.get(figtype)
+                if format is None:
+                    continue
                 for id, fignum in fignums.items():
-                    new_fignumbers[alias][id] = fignum
+                    prefixes[(docname, id)] = format % '.'.join(map(str, fignum))
+        return prefixes
 
-        return {self.config.master_doc: new_fignumbers}
+    def write(self, build_docnames, updated_docnames, method='update'):
+        # type: (Iterable[unicode], Sequence[unicode], unicode) -> None
+        entries = []
+        for entry in self.get_docx_documents():
+            start, name, coreproperties = entry
+            deps = self.get_dependencies(entry)
+            if method == 'update':
+                reason = self.get_outdated_reason(entry, deps, set(updated_docnames))
+                if reason is None:
+                    logger.info(bold('%s: ') + 'up to date, skipping', name)
+                    continue
+            else:
+                reason = 'all targets requested'
+            logger.info(bold('%s: ') + 'out of date (%s)', name, reason)
+            entries.append((entry, deps))
 
-    def write(self, *ignored):
-        # type: (Any) -> None
-        docnames = self.env.all_docs
-        if self.config.docx_documents:
-            docx_documents = self.config.docx_documents
+        if entries:
+            self.render_vector_images()
+            self.fignum_prefixes = self.assemble_fignum_prefixes()
+        self.doctree_cache.clear_resolved()
+
+        if self.parallel_ok and len(entries) > 1:
+            # the forked workers already use the -j processes, so they do not
+            # start process pools of their own
+            pooled = [worker for worker in (self.highlighter, self.image_optimizer)
+                      if worker is not None]
+            processes = [worker.processes for worker in pooled]
+            for worker in pooled:
+                worker.processes = 1
+            try:
+                tasks = ParallelTasks(self.app.parallel)
+                for entry, deps in entries:
+                    tasks.add_task(self.write_entry, entry,
+                                   lambda entry, result, deps=deps: self.entry_written(deps, result))
+                logger.info(bold('waiting for workers...'))
+                tasks.join()
+            finally:
+                for worker, count in zip(pooled, processes):
+                    worker.processes = count
         else:
-            docx_documents = [(self.config.master_doc, self.config.project,
-                              self.config.docx_coreproperties)]
-        for entry in docx_documents:
-            start, name, coreproperties = entry
-            self.config.docx_coreproperties = coreproperties
-            logger.info(bold('preparing documents... '), nonl=True)
-            self.prepare_writing(docnames)
-            logger.info('done')
-
-            logger.info(bold('assembling single document... '), nonl=True)
-            doctree = self.assemble_doctree(start)
-            self.env.toc_fignumbers = self.assemble_toc_fignumbers()
-            logger.info('')
-            logger.info(bold('writing... '), nonl=True)
-            docname = [start, name]
-            self.write_doc(docname, doctree)
-            logger.info('done')
+            for entry, deps in entries:
+                self.entry_written(deps, self.write_entry(entry))
+            if self.media.hits:
+                logger.info(bold('shared media: ') + '%d images read, %d reads and %d bytes '
+                            'saved', self.media.reads, self.media.hits, self.media.saved_bytes)
+        self.media.clear()
+        self.dump_buildinfo()
+
+    def render_vector_images(self):
+        # type: () -> None
+        """Render all SVG and PDF images into the image cache in parallel,
+        so the image converter of each output file finds them there."""
+        filenames = [path.join(self.srcdir, imgpath) for imgpath in self.env.images
+                     if path.splitext(imgpath)[1].lower() in VECTOR_IMAGE_EXTS]
+        if not filenames:
+            return
+        rendered = render_images(filenames, self.image_cache,
+                                 int(self.config.docx_image_convert_dpi),
+                                 int(self.config.docx_image_threads))
+        if rendered:
+            logger.info(bold('rendering vector images... ') + '%d rendered', rendered)
+
+    def write_entry(self, entry):
+        # type: (Tuple[unicode, unicode, Dict]) -> Tuple[unicode, bool]
+        """Write the output file of a docx_documents *entry*.
+
+        All state of the entry is passed explicitly, so entries can be
+        written by parallel worker processes.
+        """
+        start, name, coreproperties = entry
+        self.fragment_hits = self.fragment_misses = 0
+        self.merged_runs = self.merged_bytes = 0
+        self.doctree_cache.hits = self.doctree_cache.misses = 0
+        self.doctree_cache.resolved_hits = self.doctree_cache.resolved_misses = 0
+        self.math_converter.hits = self.math_converter.misses = 0
+        if self.image_optimizer is not None:
+            self.image_optimizer.hits = self.image_optimizer.misses = 0
+            self.image_optimizer.saved_bytes = 0
+        logger.info(bold('preparing documents... '), nonl=True)
+        self.prepare_writing(self.env.all_docs, coreproperties)
+        logger.info('done')
+
+        logger.info(bold('assembling single document... '), nonl=True)
+        doctree = self.assemble_doctree(start)
+        logger.info('')
+        logger.info(bold('writing %s... ') % name, nonl=True)
+        written = self.write_doc([start, name], doctree)
+        if self.fragment_cache is not None:
+            logger.info('(fragment cache: %d hits, %d misses) ',
+                        self.fragment_hits, self.fragment_misses, nonl=True)
+        logger.info('done')
+        logger.verbose('%s: merged %d runs into adjacent runs of the same style, '
+                       'about %d bytes less XML', name, self.merged_runs, self.merged_bytes)
+        logger.info(bold('%s: ') + 'resolved doctrees (cache: %d hits, %d misses)', name,
+                    self.doctree_cache.resolved_hits, self.doctree_cache.resolved_misses)
+        logger.verbose('%s: doctrees (cache: %d hits, %d misses)', name,
+                       self.doctree_cache.hits, self.doctree_cache.misses)
+        logger.verbose('%s: math (cache: %d hits, %d misses)', name,
+                       self.math_converter.hits, self.math_converter.misses)
+        if self.image_optimizer is not None:
+            logger.verbose('%s: downsampled images (cache: %d hits, %d misses), '
+                           '%d bytes less', name, self.image_optimizer.hits,
+                           self.image_optimizer.misses, self.image_optimizer.saved_bytes)
+        return name, written
+
+    def entry_written(self, deps, result):
+        # type: (Dict[unicode, Any], Tuple[unicode, bool]) -> None
+        name, written = result
+        if written:
+            style_path, style_mtime, style_digest = deps['style']
+            if style_digest is None and style_mtime is not None:
+                deps['style'][2] = template_cache.digest(style_path)
+            self.buildinfo[name] = deps
 
     def write_doc(self, docname, doctree):
         # type: (unicode, nodes.Node) -> None
         start, name = docname
         self.current_docname = start
-        self.fignumbers = self.env.toc_fignumbers.get(start, {})
         destination = StringOutput(encoding='utf-8')
         self.writer.write(doctree, destination)
         outfilename = path.join(self.outdir, os_path(name) + self.out_suffix)
         ensuredir(path.dirname(outfilename))
+        if not self.config.docx_reproducible:
+            try:
+                self.writer.save(outfilename)
+            except (IOError, OSError) as err:
+                logger.warning("error writing file %s: %s", outfilename, err)
+                return False
+            return True
+        # reproducible output: keep the file and its mtime if no byte changed
+        tmpname = outfilename + '.tmp'
         try:
-            self.writer.save(outfilename)
+            self.writer.save(tmpname)
+            if (path.isfile(outfilename) and
+                    file_digest(tmpname) == file_digest(outfilename)):
+                os.remove(tmpname)
+                logger.info('(unchanged) ', nonl=True)
+            else:
+                os.replace(tmpname, outfilename)
         except (IOError, OSError) as err:
             logger.warning("error writing file %s: %s", outfilename, err)
+            if path.exists(tmpname):
+                os.remove(tmpname)
+            return False
+        return True
 
     def finish(self):
         # type: () -> None
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxpapyrus.docxbuilder.cache
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Caches shared by the docx builder and writer.
+
+    :copyright: Copyright 2018 by nakandev.
+    :license: MIT, see LICENSE for details.
+"""
+
+import copy
+import hashlib
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+
+from docx import Document
+
+from sphinx.util import logging
+from sphinx.util.docutils import LoggingReporter
+from sphinx.util.osutil import ensuredir
+
+if False:
+    # For type annotation
+    from typing import Any, Callable, Dict, Tuple  # NOQA
+    from docutils import nodes  # NOQA
+    from sphinx.environment import BuildEnvironment  # NOQA
+
+logger = logging.getLogger(__name__)
+
+def file_digest(filename):
+    # type: (unicode) -> unicode
+    """Return the md5 hex digest of the contents of *filename*."""
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+class DiskCache(object):
+    """Pickled values stored in *dirname*, one file per key.
+
+    Keys are expected to be digests, so they are safe to use as filenames.
+    """
+
+    def __init__(self, dirname):
+        # type: (unicode) -> None
+        self.dirname = dirname
+
+    def _path(self, key):
+        # type: (unicode) -> unicode
+        return os.path.join(self.dirname, key + '.pickle')
+
+    def __contains__(self, key):
+        # type: (unicode) -> bool
+        return os.path.isfile(self._path(key))
+
+    def get(self, key, default=None):
+        # type: (unicode, Any) -> Any
+        try:
+            with open(self._path(key), 'rb') as f:
+                value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return default
+        return value
+
+    def set(self, key, value):
+        # type: (unicode, Any) -> None
+        try:
+            ensuredir(self.dirname)
+            fd, tmpname = tempfile.mkstemp(dir=self.dirname)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, self._path(key))
+        except (IOError, OSError) as err:
+            logger.warning('error writing cache file %s: %s', self._path(key), err)
+
+
+class TemplateCache(object):
+    """Parsed docx style templates, kept for the life of the process.
+
+    A template is parsed once and every caller gets a deep copy of it, so
+    repeated builds (e.g. from a daemon or a watcher) do not parse it again
+    until its modification time and contents change.
+    """
+
+    def __init__(self):
+        # type: () -> None
+        self.templates = {}  # type: Dict[unicode, Tuple[Tuple[float, int], unicode, Document]]
+
+    def _lookup(self, filename):
+        # type: (unicode) -> Tuple[Tuple[float, int], unicode, Document]
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        stat = (st.st_mtime, st.st_size)
+        cached = self.templates.get(filename)
+        if cached is not None and cached[0] == stat:
+            return cached
+        digest = file_digest(filename)
+        if cached is not None and cached[1] == digest:
+            cached = (stat, digest, cached[2])
+        else:
+            # the prototype is only ever deep-copied, never modified, so no
+            # proxy objects may keep references into its XML trees
+            prototype = Document(filename)
+            prototype.element.body.clear_content()
+            cached = (stat, digest, prototype)
+        self.templates[filename] = cached
+        return cached
+
+    def get(self, filename):
+        # type: (unicode) -> Document
+        """Return a new document with the styles of *filename* and an empty body."""
+        return copy.deepcopy(self._lookup(filename)[2])
+
+    def digest(self, filename):
+        # type: (unicode) -> unicode
+        """Return the md5 hex digest of the template *filename*."""
+        return self._lookup(filename)[1]
+
+template_cache = TemplateCache()
+
+class DoctreeCache(object):
+    """Pickled doctrees of the environment, kept in memory up to *max_bytes*.
+
+    Every :meth:`get` unpickles a new tree, which callers may modify; that
+    is faster than deep-copying a shared tree. The least recently used
+    pickles are dropped first.
+    """
+
+    def __init__(self, max_bytes):
+        # type: (int) -> None
+        self.max_bytes = max_bytes
+        self.pickles = OrderedDict()  # type: OrderedDict[Tuple[unicode, bool], Tuple[Tuple[float, int], bytes]]
+        self.size = 0
+        self.hits = self.misses = 0
+        self.resolved_hits = self.resolved_misses = 0
+
+    def get(self, env, docname, resolve=None):
+        # type: (BuildEnvironment, unicode, Callable[[nodes.document, unicode], None]) -> nodes.document
+        """Return the doctree of *docname* like ``env.get_doctree()``.
+
+        With *resolve*, return the doctree as modified by
+        ``resolve(doctree, docname)``, which is called once per document
+        until :meth:`clear_resolved`.
+        """
+        filename = os.path.join(env.doctreedir, docname + '.doctree')
+        st = os.stat(filename)
+        stat = (st.st_mtime, st.st_size)
+        key = (docname, resolve is not None)
+        cached = self.pickles.pop(key, None)
+        if cached is not None:
+            self.size -= len(cached[1])
+        if cached is not None and cached[0] == stat:
+            data = cached[1]
+            if resolve is None:
+                self.hits += 1
+            else:
+                self.resolved_hits += 1
+        elif resolve is None:
+            self.misses += 1
+            with open(filename, 'rb') as f:
+                data = f.read()
+        else:
+            self.resolved_misses += 1
+            doctree = self.get(env, docname)
+            resolve(doctree, docname)
+            data = dump_doctree(doctree)
+        if len(data) <= self.max_bytes:
+            self.pickles[key] = (stat, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self.size -= len(self.pickles.popitem(last=False)[1][1])
+        doctree = pickle.loads(data)
+        doctree.settings.env = env
+        doctree.reporter = LoggingReporter(env.doc2path(docname))
+        return doctree
+
+    def clear_resolved(self):
+        # type: () -> None
+        """Forget the resolved doctrees, which depend on the whole environment."""
+        for key in [key for key in self.pickles if key[1]]:
+            self.size -= len(self.pickles.pop(key)[1])
+
+def dump_doctree(doctree):
+    # type: (nodes.document) -> bytes
+    """Pickle *doctree* without its references to the environment, as
+    ``Builder.write_doctree()`` does."""
+    reporter, transformer, settings = doctree.reporter, doctree.transformer, doctree.settings
+    doctree.reporter = doctree.transformer = None
+    doctree.settings = copy.copy(settings)
+    doctree.settings.warning_stream = None
+    doctree.settings.env = None
+    doctree.settings.record_dependencies = None
+    try:
+        return pickle.dumps(doctree, pickle.HIGHEST_PROTOCOL)
+    finally:
+        doctree.reporter, doctree.transformer, doctree.settings = reporter, transformer, settings
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxpapyrus.docxbuilder.highlighting
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Syntax highlighting of literal blocks as formatted runs.
+
+    :copyright: Copyright 2018 by nakandev.
+    :license: MIT, see LICENSE for details.
+"""
+
+import hashlib
+import multiprocessing
+
+from pygments.filters import ErrorToken
+from pygments.lexers import get_lexer_by_name, guess_lexer
+from pygments.styles import get_style_by_name
+from pygments.util import ClassNotFound
+
+from sphinx.highlighting import lexers
+from sphinx.pygments_styles import NoneStyle, SphinxStyle
+from sphinx.util import logging
+
+if False:
+    # For type annotation
+    from typing import Any, Dict, Iterable, List, Tuple  # NOQA
+    from docutils import nodes  # NOQA
+    from pygments.lexer import Lexer  # NOQA
+    from pygments.style import Style  # NOQA
+    from sphinx.config import Config  # NOQA
+    from .cache import DiskCache  # NOQA
+
+logger = logging.getLogger(__name__)
+
+# bump when tokenize() gives other results for the same input
+HIGHLIGHT_VERSION = 1
+
+def get_style(stylename):
+    # type: (unicode) -> Style
+    """Return the Pygments style *stylename* as ``PygmentsBridge`` does."""
+    if stylename is None or stylename == 'sphinx':
+        return SphinxStyle
+    elif stylename == 'none':
+        return NoneStyle
+    elif '.' in stylename:
+        module, stylename = stylename.rsplit('.', 1)
+        return getattr(__import__(module, None, None, ['__name__']), stylename)
+    return get_style_by_name(stylename)
+
+def get_lexer(source, lang, opts):
+    # type: (unicode, unicode, Dict) -> Lexer
+    """Return the lexer ``PygmentsBridge`` uses for *source*, or None."""
+    if lang in ('py', 'python', 'py3', 'python3', 'default'):
+        console = source.startswith('>>>')
+        if lang in ('py', 'python'):
+            name = 'pycon' if console else 'python'
+        else:
+            name = 'pycon3' if console else 'python3'
+        if name not in lexers:
+            # newer Sphinx registers no Python lexers; those of Pygments
+            # are for Python 3
+            lexers[name] = get_lexer_by_name('pycon' if console else 'python')
+        return lexers[name]
+    elif lang == 'guess':
+        try:
+            return guess_lexer(source)
+        except Exception:
+            return None
+    elif lang in lexers:
+        return lexers[lang]
+    try:
+        lexer = lexers[lang] = get_lexer_by_name(lang, **(opts or {}))
+    except ClassNotFound:
+        return None
+    lexer.add_filter('raiseonerror')
+    return lexer
+
+def tokenize(source, lang, opts, stylename):
+    # type: (unicode, unicode, Dict, unicode) -> List[Tuple[unicode, Tuple[unicode, bool, bool]]]
+    """Return *source* as runs of ``(text, (color, bold, italic))``.
+
+    Adjacent tokens of the same format are merged and whitespace joins the
+    run before it. Return None if *lang* is unknown or does not lex
+    *source*.
+    """
+    lexer = get_lexer(source, lang, opts)
+    if lexer is None:
+        return None
+    style = get_style(stylename)
+    runs = []  # type: List[List]
+    try:
+        for ttype, text in lexer.get_tokens(source):
+            if not text:
+                continue
+            token = style.style_for_token(ttype)
+            fmt = (token['color'], bool(token['bold']), bool(token['italic']))
+            if runs and (runs[-1][1] == fmt or text.isspace()):
+                runs[-1][0] += text
+            else:
+                runs.append([text, fmt])
+    except ErrorToken:
+        return None
+    # lexers add a final newline
+    if runs and not source.endswith('\n') and runs[-1][0].endswith('\n'):
+        runs[-1][0] = runs[-1][0][:-1]
+    return [(text, fmt) for text, fmt in runs if text]
+
+def tokenize_args(args):
+    # type: (Tuple[unicode, unicode, Dict, unicode]) -> List[Tuple[unicode, Tuple[unicode, bool, bool]]]
+    return tokenize(*args)
+
+class Highlighter(object):
+    """Highlight literal blocks like the HTML builder does.
+
+    Tokenised blocks are stored in *cache* by the digest of the code, the
+    lexer and its options and the Pygments style *stylename*.
+    :meth:`prefetch` tokenises the blocks missing from the cache on a pool
+    of *processes* worker processes. Blocks longer than *max_size*
+    characters are left plain.
+    """
+
+    def __init__(self, config, cache, max_size, processes=1):
+        # type: (Config, DiskCache, int, int) -> None
+        self.config = config
+        self.cache = cache
+        self.max_size = max_size
+        self.processes = processes
+        self.stylename = config.pygments_style
+        self.runs = {}  # type: Dict[unicode, Any]
+        self.hits = self.misses = 0
+
+    def _args(self, node):
+        # type: (nodes.Node) -> Tuple[unicode, unicode, Dict]
+        source = node.rawsource
+        if source != node.astext() or len(source) > self.max_size:
+            # parsed literal blocks have markup
+            return None
+        lang = node.get('language', 'default')
+        opts = {}  # type: Dict
+        if lang == self.config.highlight_language:
+            opts = self.config.highlight_options
+        return source, lang, opts
+
+    def _key(self, args):
+        # type: (Tuple[unicode, unicode, Dict]) -> unicode
+        source, lang, opts = args
+        values = (HIGHLIGHT_VERSION, lang, sorted(opts.items()), self.stylename)
+        sha1 = hashlib.sha1(repr(values).encode('utf-8'))
+        sha1.update(source.encode('utf-8'))
+        return sha1.hexdigest()
+
+    def prefetch(self, literal_blocks):
+        # type: (Iterable[nodes.Node]) -> None
+        """Tokenise the *literal_blocks* which are not in the cache."""
+        tasks = {}  # type: Dict[unicode, Tuple[unicode, unicode, Dict, unicode]]
+        for node in literal_blocks:
+            args = self._args(node)
+            if args is None:
+                continue
+            key = self._key(args)
+            if key in tasks or key in self.runs:
+                continue
+            runs = self.cache.get(key)
+            if runs is not None:
+                self.runs[key] = runs
+                self.hits += 1
+            else:
+                tasks[key] = args + (self.stylename,)
+        if not tasks:
+            return
+        keys = sorted(tasks)
+        if self.processes > 1 and len(keys) > 1:
+            pool = multiprocessing.Pool(min(self.processes, len(keys)))
+            try:
+                results = pool.map(tokenize_args, [tasks[key] for key in keys], chunksize=16)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [tokenize(*tasks[key]) for key in keys]
+        for key, runs in zip(keys, results):
+            # False marks blocks which stay plain
+            runs = False if runs is None else runs
+            self.cache.set(key, runs)
+            self.runs[key] = runs
+            self.misses += 1
+
+    def get(self, node):
+        # type: (nodes.Node) -> List[Tuple[unicode, Tuple[unicode, bool, bool]]]
+        """Return the runs of the literal block *node*, or None to write it plain."""
+        args = self._args(node)
+        if args is None:
+            return None
+        key = self._key(args)
+        if key not in self.runs:
+            self.prefetch([node])
+        runs = self.runs[key]
+        if runs is False:
+            if args[1] != 'default':
+                logger.warning('Could not lex literal_block as "%s". Highlighting skipped.',
+                               args[1], type='misc', subtype='highlighting_failure',
+                               location=node)
+            return None
+        return runs
@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxpapyrus.docxbuilder.images
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Image loading and image parts of the docx builder.
+
+    :copyright: Copyright 2018 by nakandev.
+    :license: MIT, see LICENSE for details.
+"""
+
+import hashlib
+import multiprocessing
+import os
+import struct
+import subprocess
+import threading
+import zlib
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+
+from sphinx.transforms.post_transforms.images import ImageConverter
+from sphinx.util import logging
+from sphinx.util.images import guess_mimetype
+
+from docx.image.image import Image
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.opc.packuri import PackURI
+from docx.oxml.shape import CT_Inline
+from docx.parts.image import ImagePart
+from docx.shape import InlineShape
+
+from .cache import DiskCache, file_digest
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+try:
+    import cairosvg
+except ImportError:
+    cairosvg = None
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+if False:
+    # For type annotation
+    from typing import Any, Callable, Dict, Iterable, Tuple, Union  # NOQA
+    from docx.document import Document  # NOQA
+    from docx.text.run import Run  # NOQA
+    from .writer import RelationshipIndex  # NOQA
+
+logger = logging.getLogger(__name__)
+
+EMU_PER_INCH = 914400
+
+# bump when optimize_image() gives other results for the same input
+OPTIMIZE_VERSION = 1
+
+# bump when render_image() gives other results for the same input
+RENDER_VERSION = 1
+
+# extensions of the vector images which render_image() converts to PNG
+VECTOR_IMAGE_EXTS = ('.svg', '.pdf')
+
+# mimetypes of the raster images python-docx embeds, by extension; older
+# Sphinx guesses only some of them
+RASTER_MIMETYPES = {
+    '.bmp': 'image/bmp', '.gif': 'image/gif', '.jpe': 'image/jpeg', '.jpeg': 'image/jpeg',
+    '.jpg': 'image/jpeg', '.png': 'image/png', '.tif': 'image/tiff', '.tiff': 'image/tiff',
+}
+
+def image_mimetype(uri):
+    # type: (unicode) -> unicode
+    """Return the mimetype of the image *uri* by its extension, or None."""
+    return RASTER_MIMETYPES.get(os.path.splitext(uri)[1].lower()) or guess_mimetype(uri)
+
+def display_size(image, max_width=None):
+    # type: (Image, int) -> Tuple[int, int]
+    """Return the size of *image* in EMU, shrunk to *max_width*."""
+    cx, cy = image.scaled_dimensions()
+    if max_width is not None and cx > max_width:
+        cy = int(cy * float(max_width) / cx)
+        cx = max_width
+    return cx, cy
+
+def optimize_image(blob, ext, width, dpi, quality):
+    # type: (bytes, unicode, int, int, int) -> bytes
+    """Resample the PNG or JPEG *blob* to *width* pixels and recompress it.
+
+    Return the new image, or None if it is not smaller than *blob*.
+    """
+    try:
+        image = PILImage.open(BytesIO(blob))
+        height = max(1, int(round(image.size[1] * float(width) / image.size[0])))
+        if image.mode in ('1', 'P'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        image = image.resize((width, height), PILImage.LANCZOS)
+        output = BytesIO()
+        if ext == 'png':
+            image.save(output, 'PNG', optimize=True, dpi=(dpi, dpi))
+        else:
+            if image.mode not in ('RGB', 'L', 'CMYK'):
+                image = image.convert('RGB')
+            image.save(output, 'JPEG', quality=quality, optimize=True, dpi=(dpi, dpi))
+    except (IOError, OSError, ValueError):
+        return None
+    data = output.getvalue()
+    if len(data) >= len(blob):
+        return None
+    return data
+
+def set_png_dpi(blob, dpi):
+    # type: (bytes, int) -> bytes
+    """Return the PNG *blob* with its resolution set to *dpi*."""
+    ppm = int(round(dpi / 0.0254))
+    data = b'pHYs' + struct.pack('>IIB', ppm, ppm, 1)
+    phys = struct.pack('>I', 9) + data + struct.pack('>I', zlib.crc32(data) & 0xffffffff)
+    chunks = [blob[:8]]
+    pos = 8
+    while pos < len(blob):
+        length, = struct.unpack('>I', blob[pos:pos + 4])
+        end = pos + 12 + length
+        tag = blob[pos + 4:pos + 8]
+        if tag != b'pHYs':
+            chunks.append(blob[pos:end])
+        if tag == b'IHDR':
+            chunks.append(phys)
+        pos = end
+    return b''.join(chunks)
+
+def vector_tools():
+    # type: () -> Dict[unicode, unicode]
+    """Return the available renderers by the extension they render."""
+    tools = {}
+    if cairosvg is not None:
+        tools['.svg'] = 'cairosvg'
+    elif which('rsvg-convert'):
+        tools['.svg'] = 'rsvg-convert'
+    if which('pdftoppm'):
+        tools['.pdf'] = 'pdftoppm'
+    return tools
+
+def render_image(filename, tool, dpi):
+    # type: (unicode, unicode, int) -> bytes
+    """Render the SVG or the first page of the PDF *filename* to PNG.
+
+    Vector sizes keep their physical size at *dpi* pixels per inch. Return
+    None if *tool* fails.
+    """
+    try:
+        if tool == 'cairosvg':
+            blob = cairosvg.svg2png(url=filename, scale=dpi / 96.0)
+        else:
+            if tool == 'rsvg-convert':
+                command = [which('rsvg-convert'), '--zoom', str(dpi / 96.0),
+                           '--format', 'png', filename]
+            else:
+                command = [which('pdftoppm'), '-png', '-singlefile', '-r', str(dpi),
+                           filename]
+            process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            blob, err = process.communicate()
+            if process.returncode != 0:
+                return None
+    except Exception:
+        return None
+    if not blob:
+        return None
+    return set_png_dpi(blob, dpi)
+
+def render_key(digest, tool, dpi):
+    # type: (unicode, unicode, int) -> unicode
+    return hashlib.sha1(repr((RENDER_VERSION, digest, tool, dpi)).encode('utf-8')).hexdigest()
+
+def render_images(filenames, cache, dpi, processes=1):
+    # type: (Iterable[unicode], DiskCache, int, int) -> int
+    """Render the vector images *filenames* into *cache*, in parallel on
+    *processes* processes. Return the number of rendered images."""
+    tools = vector_tools()
+    tasks = {}  # type: Dict[unicode, Tuple[unicode, unicode, int]]
+    for filename in sorted(set(filenames)):
+        tool = tools.get(os.path.splitext(filename)[1].lower())
+        if tool is None or not os.path.isfile(filename):
+            continue
+        key = render_key(file_digest(filename), tool, dpi)
+        if key not in cache:
+            tasks.setdefault(key, (filename, tool, dpi))
+    tasks = sorted(tasks.items())
+    if not tasks:
+        return 0
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        try:
+            results = [pool.apply_async(render_image, args) for key, args in tasks]
+            blobs = [result.get() for result in results]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        blobs = [render_image(*args) for key, args in tasks]
+    for (key, args), blob in zip(tasks, blobs):
+        if blob is not None:
+            cache.set(key, blob)
+    return len(tasks)
+
+class DocxImageConverter(ImageConverter):
+    """Convert SVG and PDF images to PNG for the docx builder.
+
+    The images are rendered with :func:`render_image` at
+    ``docx_image_convert_dpi``, or taken from the image cache of the
+    builder which :func:`render_images` fills ahead of the write phase.
+    """
+
+    conversion_rules = [
+        ('image/svg+xml', 'image/png'),
+        ('application/pdf', 'image/png'),
+    ]
+
+    def is_available(self):
+        # type: () -> bool
+        if self.app.builder.name != 'docx':
+            return False
+        self.tools = vector_tools()
+        rules = {'image/svg+xml': '.svg', 'application/pdf': '.pdf'}
+        self.conversion_rules = [rule for rule in self.conversion_rules
+                                 if rules[rule[0]] in self.tools]
+        return bool(self.conversion_rules)
+
+    def convert(self, _from, _to):
+        # type: (unicode, unicode) -> bool
+        tool = self.tools[os.path.splitext(_from)[1].lower()]
+        dpi = int(self.config.docx_image_convert_dpi)
+        cache = self.app.builder.image_cache
+        key = render_key(file_digest(_from), tool, dpi)
+        blob = cache.get(key)
+        if blob is None:
+            blob = render_image(_from, tool, dpi)
+            if blob is None:
+                logger.warning('could not convert image %s with %s', _from, tool)
+                return False
+            cache.set(key, blob)
+        with open(_to, 'wb') as f:
+            f.write(blob)
+        return True
+
+class ImageOptimizer(object):
+    """Downsample images to *max_dpi* at their displayed size.
+
+    The results are stored in *cache* by the digest of the source image and
+    the settings, so an image is processed once across builds. Images are
+    processed on a pool of *processes* worker processes.
+    """
+
+    def __init__(self, cache, max_dpi, quality, processes=1):
+        # type: (DiskCache, int, int, int) -> None
+        self.cache = cache
+        self.max_dpi = int(max_dpi)
+        self.quality = int(quality)
+        self.processes = processes
+        self.pool = None
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.saved_bytes = 0
+
+    def optimize(self, image, cx):
+        # type: (Image, int) -> Image
+        """Return *image* downsampled for a display width of *cx* EMU."""
+        width = max(1, int(float(cx) / EMU_PER_INCH * self.max_dpi))
+        if image.ext not in ('png', 'jpg') or image.px_width <= width:
+            return image
+        key = hashlib.sha1(repr((OPTIMIZE_VERSION, image.sha1, width, self.max_dpi,
+                                 self.quality)).encode('utf-8')).hexdigest()
+        blob = self.cache.get(key)
+        hit = blob is not None
+        if not hit:
+            args = (image.blob, image.ext, width, self.max_dpi, self.quality)
+            if self.processes > 1:
+                with self.lock:
+                    if self.pool is None:
+                        self.pool = multiprocessing.Pool(self.processes)
+                blob = self.pool.apply(optimize_image, args) or b''
+            else:
+                blob = optimize_image(*args) or b''
+            self.cache.set(key, blob)
+        # callers run on several threads
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if blob:
+                self.saved_bytes += len(image.blob) - len(blob)
+        if not blob:
+            # the original is smaller
+            return image
+        return Image.from_blob(blob)
+
+    def close(self):
+        # type: () -> None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+def load_image(filename):
+    # type: (unicode) -> Union[Image, Exception]
+    """Read, hash and measure the image *filename*.
+
+    Errors are returned instead of raised, so they surface when the image
+    is used rather than in a worker thread.
+    """
+    try:
+        image = Image.from_file(filename)
+        image.sha1
+    except Exception as err:
+        return err
+    return image
+
+class MediaRegistry(object):
+    """Images loaded during a build, shared by all of its output files.
+
+    Each image file is read, hashed and measured once while its
+    modification time and size are unchanged; later output files get the
+    loaded image from memory.
+    """
+
+    def __init__(self):
+        # type: () -> None
+        self.entries = {}  # type: Dict[Tuple[unicode, int], Tuple[Tuple[float, int], Any]]
+        self.lock = threading.Lock()
+        self.reads = self.hits = self.saved_bytes = 0
+
+    def get(self, filename, max_width, load):
+        # type: (unicode, int, Callable[[unicode], Any]) -> Any
+        """Return the image *filename* measured for *max_width*, calling
+        *load* with the filename if it is not registered yet."""
+        try:
+            st = os.stat(filename)
+        except OSError as err:
+            return err
+        stat = (st.st_mtime, st.st_size)
+        key = (filename, max_width)
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None and cached[0] == stat:
+                self.hits += 1
+                self.saved_bytes += st.st_size
+                return cached[1]
+        loaded = load(filename)
+        if not isinstance(loaded, Exception):
+            with self.lock:
+                self.entries[key] = (stat, loaded)
+                self.reads += 1
+        return loaded
+
+    def clear(self):
+        # type: () -> None
+        self.entries = {}
+        self.reads = self.hits = self.saved_bytes = 0
+
+class ImageLoader(object):
+    """Load images on a thread pool ahead of their use.
+
+    :meth:`prefetch` queues the files, :meth:`get` waits for one of them.
+    Files which were not prefetched are loaded when they are asked for.
+    Images are measured for a page of *max_width* EMU and passed through
+    *optimizer* if one is given. With a *registry*, images already loaded
+    for another output file of the build are taken from it.
+    """
+
+    def __init__(self, threads, max_width=None, optimizer=None, registry=None):
+        # type: (int, int, ImageOptimizer, MediaRegistry) -> None
+        self.threads = threads
+        self.max_width = max_width
+        self.optimizer = optimizer
+        self.registry = registry
+        self.results = {}  # type: Dict[unicode, Any]
+        self.pool = None
+
+    def load(self, filename):
+        # type: (unicode) -> Union[Tuple[Image, int, int], Exception]
+        if self.registry is not None:
+            return self.registry.get(filename, self.max_width, self._load)
+        return self._load(filename)
+
+    def _load(self, filename):
+        # type: (unicode) -> Union[Tuple[Image, int, int], Exception]
+        image = load_image(filename)
+        if isinstance(image, Exception):
+            return image
+        cx, cy = display_size(image, self.max_width)
+        if self.optimizer is not None:
+            try:
+                image = self.optimizer.optimize(image, cx)
+            except Exception as err:
+                return err
+        return image, cx, cy
+
+    def prefetch(self, filenames):
+        # type: (Iterable[unicode]) -> None
+        filenames = [f for f in sorted(set(filenames)) if f not in self.results]
+        if self.threads <= 1 or len(filenames) <= 1:
+            return
+        self.pool = ThreadPool(min(self.threads, len(filenames)))
+        for filename in filenames:
+            self.results[filename] = self.pool.apply_async(self.load, (filename,))
+        self.pool.close()
+
+    def get(self, filename):
+        # type: (unicode) -> Tuple[Image, int, int]
+        """Return the image *filename* and its display size in EMU.
+
+        The error of loading the image is raised here.
+        """
+        result = self.results.get(filename)
+        if result is None:
+            loaded = self.load(filename)
+        else:
+            loaded = result.get()
+        if isinstance(loaded, Exception):
+            raise loaded
+        return loaded
+
+    def close(self):
+        # type: () -> None
+        if self.pool is not None:
+            self.pool.join()
+            self.pool = None
+        if self.optimizer is not None:
+            self.optimizer.close()
+        self.results = {}
+
+class PictureFactory(object):
+    """Add pictures to a document.
+
+    This does the work of python-docx's ``Run.add_picture`` without its
+    linear searches: image parts are found by sha1 in a dict, and new part
+    names and shape ids come from counters.
+    """
+
+    def __init__(self, docx, rels=None):
+        # type: (Document, RelationshipIndex) -> None
+        self.part = docx.part
+        # anything with the relate_to() of python-docx parts
+        self.rels = rels if rels is not None else self.part
+        self.image_parts = self.part.package.image_parts
+        self.parts = dict((part.sha1, part) for part in self.image_parts)
+        used = [part.partname.idx for part in self.image_parts]
+        self.next_image = max(used) + 1 if used else 1
+        self.next_shape_id = self.part.next_id
+
+    def new_shape_id(self):
+        # type: () -> int
+        shape_id = self.next_shape_id
+        self.next_shape_id += 1
+        return shape_id
+
+    def image_part(self, image):
+        # type: (Image) -> ImagePart
+        """Return the image part of *image*, adding it on first use."""
+        part = self.parts.get(image.sha1)
+        if part is None:
+            partname = PackURI('/word/media/image%d.%s' % (self.next_image, image.ext))
+            self.next_image += 1
+            part = ImagePart.from_image(image, partname)
+            self.image_parts.append(part)
+            self.parts[image.sha1] = part
+        return part
+
+    def relate_image(self, image):
+        # type: (Image) -> unicode
+        """Return the rId of the relationship to the image part of *image*."""
+        return self.rels.relate_to(self.image_part(image), RT.IMAGE)
+
+    def add_picture(self, run, image, cx, cy, name):
+        # type: (Run, Image, int, int, unicode) -> InlineShape
+        """Add *image* to *run* as the picture *name* of *cx* by *cy* EMU."""
+        rId = self.relate_image(image)
+        inline = CT_Inline.new_pic_inline(self.new_shape_id(), rId, name, cx, cy)
+        run._r.add_drawing(inline)
+        return InlineShape(inline)
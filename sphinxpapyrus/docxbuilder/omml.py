@@ -0,0 +1,641 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxpapyrus.docxbuilder.omml
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Conversion of LaTeX math to Office Math (OMML).
+
+    The converter covers the LaTeX which Sphinx documents commonly use:
+    fractions, scripts, roots, large operators, delimiters, accents, fonts,
+    text, matrices and aligned environments. Anything else is reported, and
+    the writer falls back to the LaTeX source.
+
+    :copyright: Copyright 2018 by nakandev.
+    :license: MIT, see LICENSE for details.
+"""
+
+import hashlib
+import re
+
+from docx.oxml.ns import nsmap, qn
+from lxml import etree
+
+from sphinx.util import logging
+
+if False:
+    # For type annotation
+    from typing import Any, Dict, List, Set, Tuple  # NOQA
+    from docutils import nodes  # NOQA
+    from .cache import DiskCache  # NOQA
+
+logger = logging.getLogger(__name__)
+
+# bump when latex_to_omml() gives other results for the same input
+OMML_VERSION = 2
+
+MATH_NSMAP = {'m': nsmap['m']}
+
+TOKEN_RE = re.compile(r'\\([a-zA-Z]+)|\\(.)|(\s+)|(.)', re.S)
+
+# a % which is not escaped by a backslash, up to the end of the line
+COMMENT_RE = re.compile(r'(?<!\\)((?:\\\\)*)%[^\n]*')
+
+SYMBOLS = {
+    # greek letters
+    'alpha': u'α', 'beta': u'β', 'gamma': u'γ', 'delta': u'δ',
+    'epsilon': u'ϵ', 'varepsilon': u'ε', 'zeta': u'ζ', 'eta': u'η',
+    'theta': u'θ', 'vartheta': u'ϑ', 'iota': u'ι', 'kappa': u'κ',
+    'lambda': u'λ', 'mu': u'μ', 'nu': u'ν', 'xi': u'ξ',
+    'pi': u'π', 'varpi': u'ϖ', 'rho': u'ρ', 'varrho': u'ϱ',
+    'sigma': u'σ', 'varsigma': u'ς', 'tau': u'τ', 'upsilon': u'υ',
+    'phi': u'ϕ', 'varphi': u'φ', 'chi': u'χ', 'psi': u'ψ',
+    'omega': u'ω', 'Gamma': u'Γ', 'Delta': u'Δ', 'Theta': u'Θ',
+    'Lambda': u'Λ', 'Xi': u'Ξ', 'Pi': u'Π', 'Sigma': u'Σ',
+    'Upsilon': u'Υ', 'Phi': u'Φ', 'Psi': u'Ψ', 'Omega': u'Ω',
+    # binary operators and relations
+    'pm': u'±', 'mp': u'∓', 'times': u'×', 'div': u'÷',
+    'cdot': u'⋅', 'ast': u'∗', 'star': u'⋆', 'circ': u'∘',
+    'bullet': u'∙', 'oplus': u'⊕', 'ominus': u'⊖', 'otimes': u'⊗',
+    'cup': u'∪', 'cap': u'∩', 'setminus': u'∖', 'wedge': u'∧',
+    'land': u'∧', 'vee': u'∨', 'lor': u'∨', 'neg': u'¬',
+    'lnot': u'¬', 'leq': u'≤', 'le': u'≤', 'geq': u'≥',
+    'ge': u'≥', 'neq': u'≠', 'ne': u'≠', 'll': u'≪', 'gg': u'≫',
+    'approx': u'≈', 'sim': u'∼', 'simeq': u'≃', 'cong': u'≅',
+    'equiv': u'≡', 'propto': u'∝', 'in': u'∈', 'notin': u'∉',
+    'ni': u'∋', 'subset': u'⊂', 'supset': u'⊃', 'subseteq': u'⊆',
+    'supseteq': u'⊇', 'mid': u'∣', 'parallel': u'∥', 'perp': u'⊥',
+    'vdash': u'⊢', 'models': u'⊨', 'prec': u'≺', 'succ': u'≻',
+    # arrows
+    'to': u'→', 'rightarrow': u'→', 'leftarrow': u'←', 'gets': u'←',
+    'leftrightarrow': u'↔', 'Rightarrow': u'⇒', 'Leftarrow': u'⇐',
+    'Leftrightarrow': u'⇔', 'iff': u'⇔', 'implies': u'⇒',
+    'mapsto': u'↦', 'uparrow': u'↑', 'downarrow': u'↓',
+    'longrightarrow': u'⟶', 'longleftarrow': u'⟵',
+    'Longrightarrow': u'⟹', 'longmapsto': u'⟼',
+    # other symbols
+    'infty': u'∞', 'partial': u'∂', 'nabla': u'∇', 'forall': u'∀',
+    'exists': u'∃', 'emptyset': u'∅', 'varnothing': u'∅',
+    'aleph': u'ℵ', 'hbar': u'ℏ', 'ell': u'ℓ', 'Re': u'ℜ',
+    'Im': u'ℑ', 'angle': u'∠', 'prime': u'′', 'top': u'⊤',
+    'bot': u'⊥', 'ldots': u'…', 'dots': u'…', 'cdots': u'⋯',
+    'vdots': u'⋮', 'ddots': u'⋱', 'langle': u'⟨', 'rangle': u'⟩',
+    'lfloor': u'⌊', 'rfloor': u'⌋', 'lceil': u'⌈', 'rceil': u'⌉',
+    'lbrace': u'{', 'rbrace': u'}', 'vert': u'|', 'Vert': u'‖',
+    'lvert': u'|', 'rvert': u'|', 'lVert': u'‖', 'rVert': u'‖',
+    '{': u'{', '}': u'}', '|': u'‖', '_': u'_', '%': u'%', '$': u'$',
+    '#': u'#', '&': u'&',
+    # spaces
+    ',': u'\u2009', ':': u'\u205f', '>': u'\u205f', ';': u'\u2004', ' ': u' ',
+    'quad': u'\u2003', 'qquad': u'\u2003\u2003',
+}
+
+# operator names written upright; the LIMITS ones take limits below them
+FUNCTIONS = frozenset((
+    'arccos', 'arcsin', 'arctan', 'arg', 'cos', 'cosh', 'cot', 'coth', 'csc', 'deg',
+    'det', 'dim', 'exp', 'gcd', 'hom', 'inf', 'ker', 'lg', 'lim', 'liminf', 'limsup',
+    'ln', 'log', 'max', 'min', 'Pr', 'sec', 'sin', 'sinh', 'sup', 'tan', 'tanh',
+))
+LIMITS = frozenset(('det', 'gcd', 'inf', 'lim', 'liminf', 'limsup', 'max', 'min',
+                    'Pr', 'sup'))
+
+NARY = {
+    'sum': u'∑', 'prod': u'∏', 'coprod': u'∐', 'int': u'∫',
+    'iint': u'∬', 'iiint': u'∭', 'oint': u'∮', 'bigcup': u'⋃',
+    'bigcap': u'⋂', 'bigvee': u'⋁', 'bigwedge': u'⋀',
+    'bigoplus': u'⨁', 'bigotimes': u'⨂', 'bigsqcup': u'⨆',
+}
+
+ACCENTS = {
+    'hat': u'\u0302', 'widehat': u'\u0302', 'check': u'\u030c', 'tilde': u'\u0303',
+    'widetilde': u'\u0303', 'acute': u'\u0301', 'grave': u'\u0300', 'dot': u'\u0307',
+    'ddot': u'\u0308', 'breve': u'\u0306', 'bar': u'\u0305', 'vec': u'\u20d7',
+}
+
+# (m:scr, m:sty) of the font commands
+FONTS = {
+    'mathrm': (None, 'p'), 'mathbf': (None, 'b'), 'mathit': (None, 'i'),
+    'boldsymbol': (None, 'bi'), 'bm': (None, 'bi'),
+    'mathbb': ('double-struck', 'p'), 'mathcal': ('script', 'p'),
+    'mathscr': ('script', 'p'), 'mathfrak': ('fraktur', 'p'),
+    'mathsf': ('sans-serif', 'p'), 'mathtt': ('monospace', 'p'),
+}
+
+TEXTS = frozenset(('text', 'textrm', 'textnormal', 'mbox', 'hbox', 'textit', 'textbf'))
+
+DELIMITERS = {
+    '(': u'(', ')': u')', '[': u'[', ']': u']', '|': u'|', '/': u'/', '<': u'⟨',
+    '>': u'⟩', '.': u'', '\\{': u'{', '\\}': u'}', '\\|': u'‖',
+    '\\lbrace': u'{', '\\rbrace': u'}', '\\langle': u'⟨', '\\rangle': u'⟩',
+    '\\lfloor': u'⌊', '\\rfloor': u'⌋', '\\lceil': u'⌈',
+    '\\rceil': u'⌉', '\\vert': u'|', '\\Vert': u'‖',
+    '\\lvert': u'|', '\\rvert': u'|', '\\lVert': u'‖', '\\rVert': u'‖',
+}
+
+# (opening, closing) delimiters of the matrix environments
+MATRICES = {
+    'matrix': None, 'smallmatrix': None, 'array': None, 'pmatrix': (u'(', u')'),
+    'bmatrix': (u'[', u']'), 'Bmatrix': (u'{', u'}'), 'vmatrix': (u'|', u'|'),
+    'Vmatrix': (u'‖', u'‖'), 'cases': (u'{', u''),
+}
+
+ALIGNED = frozenset(('aligned', 'align', 'align*', 'alignat', 'alignat*', 'split',
+                     'gather', 'gather*', 'gathered', 'eqnarray', 'eqnarray*',
+                     'multline', 'multline*', 'equation', 'equation*'))
+
+# commands which change only the size or the numbering
+IGNORED = frozenset(('displaystyle', 'textstyle', 'scriptstyle', 'scriptscriptstyle',
+                     'limits', 'nolimits', 'nonumber', 'notag', 'big', 'Big', 'bigg',
+                     'Bigg', 'bigl', 'bigr', 'Bigl', 'Bigr', 'biggl', 'biggr', 'Biggl',
+                     'Biggr', 'middle', '!', 'strut'))
+
+class MathError(ValueError):
+    """LaTeX which the converter does not support."""
+
+def normalize_latex(latex):
+    # type: (unicode) -> unicode
+    """Return *latex* without comments and with runs of whitespace collapsed
+    into one space."""
+    return u' '.join(COMMENT_RE.sub(r'\1', latex).split())
+
+def _m(tag, children=()):
+    # type: (unicode, List[etree._Element]) -> etree._Element
+    """Return a new ``m:`` element *tag* of *children*."""
+    element = etree.Element(qn('m:' + tag), nsmap=MATH_NSMAP)
+    element.extend(children)
+    return element
+
+def _pr(tag, *props):
+    # type: (unicode, Tuple[unicode, unicode]) -> etree._Element
+    """Return the ``m:`` properties element *tag* of the ordered *props*,
+    ``(name, val)`` pairs."""
+    element = _m(tag)
+    for name, val in props:
+        prop = etree.SubElement(element, qn('m:' + name))
+        if val is not None:
+            prop.set(qn('m:val'), val)
+    return element
+
+class _Run(object):
+    """Text of one font; adjacent runs of the same font are merged."""
+
+    def __init__(self, text, scr=None, sty=None, nor=False, limits=False):
+        # type: (unicode, unicode, unicode, bool, bool) -> None
+        self.text = text
+        self.scr = scr
+        self.sty = sty
+        self.nor = nor
+        self.aln = False
+        self.limits = limits
+
+    def font(self):
+        # type: () -> Tuple[unicode, unicode, bool]
+        return self.scr, self.sty, self.nor
+
+class _Group(object):
+    """Braced items, which take scripts as a whole."""
+
+    def __init__(self, items, limits=False):
+        # type: (List[Any], bool) -> None
+        self.items = items
+        self.limits = limits
+
+class _Nary(object):
+    """A large operator; its operand is the rest of the enclosing list."""
+
+    def __init__(self, chr, integral):
+        # type: (unicode, bool) -> None
+        self.chr = chr
+        self.integral = integral
+        self.sub = self.sup = None  # type: List[Any]
+        self.e = []  # type: List[Any]
+
+class _Parser(object):
+    """Recursive descent parser of LaTeX math into OMML elements."""
+
+    def __init__(self, latex):
+        # type: (unicode) -> None
+        self.latex = latex
+        self.tokens = []  # type: List[Tuple[unicode, unicode, int, int]]
+        for match in TOKEN_RE.finditer(latex):
+            if match.group(1) is not None:
+                token = ('cmd', match.group(1))
+            elif match.group(2) is not None:
+                token = ('cmd', match.group(2))
+            elif match.group(3) is not None:
+                token = ('space', u' ')
+            else:
+                token = ('char', match.group(4))
+            self.tokens.append(token + (match.start(), match.end()))
+        self.index = 0
+        self.font = {}  # type: Dict[unicode, Any]
+
+    def peek(self):
+        # type: () -> Tuple[unicode, unicode]
+        while self.index < len(self.tokens) and self.tokens[self.index][0] == 'space':
+            self.index += 1
+        if self.index < len(self.tokens):
+            return self.tokens[self.index][:2]
+        return None
+
+    def next(self):
+        # type: () -> Tuple[unicode, unicode]
+        token = self.peek()
+        if token is not None:
+            self.index += 1
+        return token
+
+    def expect(self, token):
+        # type: (Tuple[unicode, unicode]) -> None
+        found = self.next()
+        if found != token:
+            raise MathError('expected %s, found %s' % (token[1], found and found[1]))
+
+    def raw_argument(self):
+        # type: () -> unicode
+        """Return the source of the next braced argument without the braces."""
+        self.expect(('char', '{'))
+        start = self.tokens[self.index - 1][3]
+        depth = 1
+        while self.index < len(self.tokens):
+            kind, value, _, end = self.tokens[self.index]
+            self.index += 1
+            if kind == 'char' and value == '{':
+                depth += 1
+            elif kind == 'char' and value == '}':
+                depth -= 1
+                if depth == 0:
+                    return self.latex[start:end - 1]
+        raise MathError('missing }')
+
+    def parse(self):
+        # type: () -> etree._Element
+        rows = self.parse_rows(())
+        if self.peek() is not None:
+            raise MathError('unexpected %s' % self.peek()[1])
+        if len(rows) > 1:
+            return _m('oMath', [self.equation_array(rows)])
+        return _m('oMath', self.build(sum(rows[0], [])))
+
+    def parse_rows(self, stops):
+        # type: (Set[Tuple[unicode, unicode]]) -> List[List[List[Any]]]
+        """Parse cells separated by ``&`` in rows separated by ``\\\\``."""
+        stops = set(stops) | set([('char', '&'), ('cmd', '\\')])
+        rows = [[self.parse_list(stops)]]
+        while True:
+            token = self.peek()
+            if token == ('char', '&'):
+                self.next()
+                rows[-1].append(self.parse_list(stops))
+            elif token == ('cmd', '\\'):
+                self.next()
+                if self.peek() == ('char', '['):
+                    # row spacing
+                    while self.next() not in (('char', ']'), None):
+                        pass
+                rows.append([self.parse_list(stops)])
+            else:
+                break
+        if len(rows) > 1 and rows[-1] == [[]]:
+            rows.pop()
+        return rows
+
+    def parse_list(self, stops):
+        # type: (Set[Tuple[unicode, unicode]]) -> List[Any]
+        items = []  # type: List[Any]
+        while True:
+            token = self.peek()
+            if token is None or token in stops:
+                return items
+            if token in (('char', '^'), ('char', '_')):
+                item = _Group([])  # type: Any
+            else:
+                item = self.parse_atom(self.next())
+                if item is None:
+                    continue
+            item = self.parse_scripts(item)
+            if isinstance(item, _Nary):
+                item.e = self.parse_list(stops)
+            items.append(item)
+
+    def parse_scripts(self, item):
+        # type: (Any) -> Any
+        sub = sup = None
+        while True:
+            token = self.peek()
+            if token in (('cmd', 'limits'), ('cmd', 'nolimits')):
+                self.next()
+            elif token == ('char', '^') and sup is None:
+                self.next()
+                sup = self.parse_argument()
+            elif token == ('char', '_') and sub is None:
+                self.next()
+                sub = self.parse_argument()
+            elif token in (('char', '^'), ('char', '_')):
+                raise MathError('double script')
+            else:
+                break
+        if sub is None and sup is None:
+            return item
+        if isinstance(item, _Nary):
+            item.sub, item.sup = sub, sup
+            return item
+        if isinstance(item, (_Run, _Group)) and item.limits and sup is None:
+            return _m('limLow', [_m('e', self.build([item])), _m('lim', self.build(sub))])
+        e = _m('e', self.build([item]))
+        if sup is None:
+            return _m('sSub', [e, _m('sub', self.build(sub))])
+        elif sub is None:
+            return _m('sSup', [e, _m('sup', self.build(sup))])
+        return _m('sSubSup', [e, _m('sub', self.build(sub)), _m('sup', self.build(sup))])
+
+    def parse_argument(self):
+        # type: () -> List[Any]
+        token = self.next()
+        if token is None:
+            raise MathError('missing argument')
+        item = self.parse_atom(token)
+        if item is None:
+            raise MathError('missing argument')
+        if isinstance(item, _Group):
+            return item.items
+        return [item]
+
+    def parse_group(self):
+        # type: () -> List[Any]
+        items = self.parse_list(set([('char', '}')]))
+        self.expect(('char', '}'))
+        return items
+
+    def parse_delimiter(self):
+        # type: () -> unicode
+        token = self.next()
+        if token is None:
+            raise MathError('missing delimiter')
+        name = token[1] if token[0] == 'char' else '\\' + token[1]
+        if name not in DELIMITERS:
+            raise MathError('unknown delimiter %s' % name)
+        return DELIMITERS[name]
+
+    def run(self, text):
+        # type: (unicode) -> _Run
+        return _Run(text, **self.font)
+
+    def parse_atom(self, token):
+        # type: (Tuple[unicode, unicode]) -> Any
+        kind, value = token
+        if kind == 'char':
+            if value == '{':
+                return _Group(self.parse_group())
+            elif value in '}&^_':
+                raise MathError('unexpected %s' % value)
+            elif value == '~':
+                return self.run(u' ')
+            elif value == "'":
+                return self.run(u'′')
+            return self.run(value)
+        if value in SYMBOLS:
+            return self.run(SYMBOLS[value])
+        elif value in FUNCTIONS:
+            return _Run(value, sty='p', limits=value in LIMITS)
+        elif value == 'operatorname':
+            limits = self.peek() == ('char', '*')
+            if limits:
+                self.next()
+            font = self.font
+            self.font = {'sty': 'p'}
+            try:
+                return _Group(self.parse_argument(), limits)
+            finally:
+                self.font = font
+        elif value in NARY:
+            return _Nary(NARY[value], value.endswith('int'))
+        elif value in ('frac', 'dfrac', 'tfrac', 'cfrac'):
+            num = self.build(self.parse_argument())
+            den = self.build(self.parse_argument())
+            return _m('f', [_m('num', num), _m('den', den)])
+        elif value == 'binom':
+            num = self.build(self.parse_argument())
+            den = self.build(self.parse_argument())
+            f = _m('f', [_pr('fPr', ('type', 'noBar')), _m('num', num), _m('den', den)])
+            return _m('d', [_m('e', [f])])
+        elif value == 'sqrt':
+            if self.peek() == ('char', '['):
+                self.next()
+                deg = self.parse_list(set([('char', ']')]))
+                self.expect(('char', ']'))
+                props = []  # type: List[etree._Element]
+            else:
+                deg = []
+                props = [_pr('radPr', ('degHide', '1'))]
+            e = self.build(self.parse_argument())
+            return _m('rad', props + [_m('deg', self.build(deg)), _m('e', e)])
+        elif value == 'left':
+            begin = self.parse_delimiter()
+            items = self.parse_list(set([('cmd', 'right')]))
+            self.expect(('cmd', 'right'))
+            return self.delimited(begin, self.parse_delimiter(), self.build(items))
+        elif value in ACCENTS:
+            e = self.build(self.parse_argument())
+            return _m('acc', [_pr('accPr', ('chr', ACCENTS[value])), _m('e', e)])
+        elif value in ('overline', 'underline'):
+            pos = 'top' if value == 'overline' else 'bot'
+            e = self.build(self.parse_argument())
+            return _m('bar', [_pr('barPr', ('pos', pos)), _m('e', e)])
+        elif value in TEXTS:
+            return _Run(self.raw_argument(), nor=True)
+        elif value in FONTS:
+            font = self.font
+            self.font = dict(zip(('scr', 'sty'), FONTS[value]))
+            try:
+                return _Group(self.parse_argument())
+            finally:
+                self.font = font
+        elif value == 'begin':
+            return self.parse_environment(self.raw_argument().strip())
+        elif value == 'label':
+            self.raw_argument()
+            return None
+        elif value in IGNORED:
+            return None
+        raise MathError('unsupported command \\%s' % value)
+
+    def parse_environment(self, name):
+        # type: (unicode) -> Any
+        if name not in MATRICES and name not in ALIGNED:
+            raise MathError('unsupported environment %s' % name)
+        if name in ('array', 'alignat', 'alignat*'):
+            # column specification
+            self.raw_argument()
+        rows = self.parse_rows(set([('cmd', 'end')]))
+        self.expect(('cmd', 'end'))
+        if self.raw_argument().strip() != name:
+            raise MathError('unbalanced environment %s' % name)
+        if name in ALIGNED:
+            if len(rows) == 1:
+                return _Group(sum(rows[0], []))
+            return self.equation_array(rows)
+        count = max(len(row) for row in rows)
+        mPr = _m('mPr')
+        mcs = etree.SubElement(mPr, qn('m:mcs'))
+        mc = etree.SubElement(mcs, qn('m:mc'))
+        mc.append(_pr('mcPr', ('count', str(count)),
+                      ('mcJc', 'left' if name == 'cases' else 'center')))
+        matrix = _m('m', [mPr])
+        for row in rows:
+            mr = etree.SubElement(matrix, qn('m:mr'))
+            for index in range(count):
+                mr.append(_m('e', self.build(row[index] if index < len(row) else [])))
+        if MATRICES[name] is None:
+            return matrix
+        return self.delimited(MATRICES[name][0], MATRICES[name][1], [matrix])
+
+    def delimited(self, begin, end, children):
+        # type: (unicode, unicode, List[etree._Element]) -> etree._Element
+        props = []
+        if begin != u'(':
+            props.append(('begChr', begin))
+        if end != u')':
+            props.append(('endChr', end))
+        d = _m('d', [_pr('dPr', *props)] if props else [])
+        d.append(_m('e', children))
+        return d
+
+    def equation_array(self, rows):
+        # type: (List[List[List[Any]]]) -> etree._Element
+        """Return the rows as an ``m:eqArr``, aligned at the ``&`` cells."""
+        eqArr = _m('eqArr')
+        for row in rows:
+            items = []  # type: List[Any]
+            for index, cell in enumerate(row):
+                if index and cell and isinstance(cell[0], _Run):
+                    cell[0].aln = True
+                items.extend(cell)
+            eqArr.append(_m('e', self.build(items)))
+        return eqArr
+
+    def build(self, items):
+        # type: (List[Any]) -> List[etree._Element]
+        """Return the OMML elements of *items*, merging adjacent runs."""
+        flat = []  # type: List[Any]
+        for item in items:
+            if isinstance(item, _Group):
+                flat.extend(self.build(item.items))
+            elif (isinstance(item, _Run) and flat and isinstance(flat[-1], _Run)
+                  and not item.aln and flat[-1].font() == item.font()):
+                run = _Run(flat[-1].text + item.text, *flat[-1].font())
+                run.aln = flat[-1].aln
+                flat[-1] = run
+            else:
+                flat.append(item)
+        elements = []
+        for item in flat:
+            if isinstance(item, _Run):
+                elements.append(self.run_element(item))
+            elif isinstance(item, _Nary):
+                elements.append(self.nary_element(item))
+            else:
+                elements.append(item)
+        return elements
+
+    def run_element(self, run):
+        # type: (_Run) -> etree._Element
+        r = _m('r')
+        props = []
+        if run.nor:
+            props.append(('nor', None))
+        if run.scr:
+            props.append(('scr', run.scr))
+        if run.sty:
+            props.append(('sty', run.sty))
+        if run.aln:
+            props.append(('aln', None))
+        if props:
+            r.append(_pr('rPr', *props))
+        t = etree.SubElement(r, qn('m:t'))
+        t.text = run.text
+        if len(run.text.strip()) < len(run.text):
+            t.set(qn('xml:space'), 'preserve')
+        return r
+
+    def nary_element(self, nary):
+        # type: (_Nary) -> etree._Element
+        props = [('chr', nary.chr), ('limLoc', 'subSup' if nary.integral else 'undOvr')]
+        if nary.sub is None:
+            props.append(('subHide', '1'))
+        if nary.sup is None:
+            props.append(('supHide', '1'))
+        return _m('nary', [_pr('naryPr', *props),
+                           _m('sub', self.build(nary.sub or [])),
+                           _m('sup', self.build(nary.sup or [])),
+                           _m('e', self.build(nary.e))])
+
+def latex_to_omml(latex):
+    # type: (unicode) -> etree._Element
+    """Return the ``m:oMath`` element of the LaTeX math *latex*.
+
+    Raise :exc:`MathError` if *latex* uses unsupported markup.
+    """
+    omath = _Parser(latex).parse()
+    etree.cleanup_namespaces(omath)
+    return omath
+
+def display_latex(latex):
+    # type: (unicode) -> unicode
+    """Return the display math *latex*, whose equations are separated by
+    blank lines as in Sphinx, as one aligned equation.  Comments are removed
+    from each equation first so that they cannot swallow the next one."""
+    parts = [COMMENT_RE.sub(r'\1', part) for part in latex.split('\n\n')]
+    parts = [part for part in parts if part.strip()]
+    if len(parts) > 1:
+        return u'\\begin{aligned}%s\\end{aligned}' % u'\\\\'.join(parts)
+    return latex
+
+def math_paragraph(omath, jc='center'):
+    # type: (etree._Element, unicode) -> etree._Element
+    """Return *omath* in an ``m:oMathPara`` justified *jc*, for display math."""
+    para = _m('oMathPara', [_pr('oMathParaPr', ('jc', jc))])
+    para.append(omath)
+    return para
+
+class MathConverter(object):
+    """LaTeX math converted to OMML and stored in *cache* by the digest of
+    the normalised LaTeX, so repeated equations are converted once."""
+
+    def __init__(self, cache):
+        # type: (DiskCache) -> None
+        self.cache = cache
+        self.omml = {}  # type: Dict[unicode, Tuple[bool, Any]]
+        self.hits = self.misses = 0
+
+    def _key(self, latex):
+        # type: (unicode) -> unicode
+        values = u'%d\n%s' % (OMML_VERSION, latex)
+        return hashlib.sha1(values.encode('utf-8')).hexdigest()
+
+    def get(self, latex, node=None):
+        # type: (unicode, nodes.Node) -> etree._Element
+        """Return a new ``m:oMath`` element of *latex*, or None to write it
+        as text."""
+        latex = normalize_latex(latex)
+        key = self._key(latex)
+        value = self.omml.get(key)
+        if value is None:
+            value = self.cache.get(key)
+            if value is None:
+                self.misses += 1
+                try:
+                    value = (True, etree.tostring(latex_to_omml(latex)))
+                except MathError as err:
+                    value = (False, str(err))
+                self.cache.set(key, value)
+            else:
+                self.hits += 1
+            self.omml[key] = value
+        else:
+            self.hits += 1
+        converted, data = value
+        if not converted:
+            logger.warning('Could not convert math to OMML (%s): %s', data, latex,
+                           location=node, type='docx', subtype='math')
+            return None
+        return etree.fromstring(data)
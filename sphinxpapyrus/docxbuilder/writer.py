@@ -9,9 +9,16 @@
     :license: MIT, see LICENSE for details.
 """
 
-import sys
 import os
 import re
+import sys
+import shutil
+import hashlib
+import tempfile
+import zipfile
+from copy import deepcopy
+from datetime import datetime, timedelta
+from io import BytesIO
 
 from docutils import nodes, writers
 
@@ -19,23 +26,444 @@ from sphinx import addnodes
 from sphinx.locale import admonitionlabels, _
 from sphinx.util import logging
 
-from docx import Document
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.oxml import OxmlElement, parse_xml
+from docx.oxml.ns import nsdecls, nsmap, qn
+from docx.oxml.numbering import CT_Num
+from docx.shared import Emu, Inches
+from docx.table import Table, _Cell
+from docx.text.paragraph import Paragraph
+from docx.enum.style import WD_STYLE_TYPE
+from docx.image.image import Image
 from docx.enum.table import WD_TABLE_ALIGNMENT
 from docx.enum.text import WD_BREAK
 from docx.enum.text import WD_TAB_ALIGNMENT
 from docx.enum.text import WD_TAB_LEADER
 
+from lxml import etree
+
+from .cache import template_cache
+from .images import ImageLoader, PictureFactory, image_mimetype
+from .omml import display_latex, math_paragraph
+
 package_dir = os.path.abspath(os.path.dirname(__file__))
 
+# bump when the layout of cached fragments changes
+FRAGMENT_VERSION = 7
+
+# timestamp of the zip members of reproducible output, the earliest zip allows
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
 logger = logging.getLogger(__name__)
 
-# monkey patch
-from docx.oxml.xmlchemy import BaseOxmlElement, ZeroOrOne
-from docx.oxml.simpletypes import XsdInt
-from docx.oxml import register_element_cls
-class CT_TrPr(BaseOxmlElement):
-    tblHeader = ZeroOrOne('w:tblHeader')
-register_element_cls('w:trPr', CT_TrPr)
+def table_layout(rows, cols):
+    # type: (List[nodes.row], int) -> List[List[Tuple[nodes.entry, int, int, unicode]]]
+    """Lay out the entries of table *rows* on a grid of *cols* columns.
+
+    Return the cells of each row as ``(entry, col, gridspan, vmerge)``.
+    Cells covered by a ``morerows`` span of an upper row have no entry and
+    continue its vertical merge; missing cells at the end of a row are
+    filled with empty cells.
+    """
+    rowspans = [0] * cols  # rows still covered by the span started above
+    colspans = [1] * cols
+    layout = []
+    for row in rows:
+        cells = []
+        entries = iter(row.children)
+        col = 0
+        while col < cols:
+            if rowspans[col]:
+                rowspans[col] -= 1
+                cells.append((None, col, colspans[col], 'continue'))
+                col += colspans[col]
+                continue
+            entry = next(entries, None)
+            if entry is None:
+                cells.append((None, col, 1, None))
+                col += 1
+                continue
+            gridspan = min(entry.get('morecols', 0) + 1, cols - col)
+            vmerge = None
+            if entry.get('morerows', 0):
+                rowspans[col] = entry['morerows']
+                colspans[col] = gridspan
+                vmerge = 'restart'
+            cells.append((entry, col, gridspan, vmerge))
+            col += gridspan
+        layout.append(cells)
+    return layout
+
+def estimate_colwidths(layout, cols):
+    # type: (List[List[Tuple[nodes.entry, int, int, unicode]]], int) -> List[int]
+    """Estimate relative column widths from the text of the entries.
+
+    A column is as wide as its longest line, but at most twice as wide as
+    its average line, so that a single long entry does not squeeze the
+    other columns.
+    """
+    longest = [0] * cols
+    total = [0] * cols
+    count = [0] * cols
+    for cells in layout:
+        for entry, col, gridspan, vmerge in cells:
+            if entry is None or gridspan > 1:
+                continue
+            lines = entry.astext().splitlines() or ['']
+            length = max(len(line) for line in lines)
+            longest[col] = max(longest[col], length)
+            total[col] += length
+            count[col] += 1
+    widths = []
+    for col in range(cols):
+        average = float(total[col]) / count[col] if count[col] else 0
+        widths.append(min(longest[col], 2 * average) + 3)
+    return widths
+
+def new_tbl(layout, grid_widths, header_rows=0, cell_widths=False, fixed=False):
+    # type: (List[List[Tuple[nodes.entry, int, int, unicode]]], List[int], int, bool, bool) -> Tuple[CT_Tbl, List[List[CT_Tc]]]
+    """Return a ``w:tbl`` element for a :func:`table_layout` and its cells.
+
+    *grid_widths* are the widths of the grid columns in EMU. The first
+    *header_rows* rows are repeated on each page. With *cell_widths* the
+    cells get the widths of their columns, and a *fixed* table keeps these
+    widths instead of being fitted to its contents by Word.
+    """
+    if fixed:
+        tblW = '<w:tblW w:type="dxa" w:w="%d"/><w:tblLayout w:type="fixed"/>' % (
+            Emu(sum(grid_widths)).twips)
+    else:
+        tblW = '<w:tblW w:type="auto" w:w="0"/>'
+    tbl = parse_xml(
+        '<w:tbl %s>'
+        '<w:tblPr>'
+        '%s'
+        '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0"'
+        ' w:noHBand="0" w:noVBand="1" w:val="04A0"/>'
+        '</w:tblPr>'
+        '<w:tblGrid/>'
+        '</w:tbl>' % (nsdecls('w'), tblW))
+    tblGrid = tbl[1]
+    twips = [Emu(width).twips for width in grid_widths]
+    for width in twips:
+        tblGrid.append(OxmlElement('w:gridCol', {qn('w:w'): str(width)}))
+    # all cells are copied from one template
+    tc_template = parse_xml(
+        '<w:tc %s><w:tcPr><w:tcW w:type="auto" w:w="0"/></w:tcPr><w:p/></w:tc>'
+        % nsdecls('w'))
+    if cell_widths or fixed:
+        tc_template[0][0].set(qn('w:type'), 'dxa')
+    tcs = []
+    for index, cells in enumerate(layout):
+        tr = OxmlElement('w:tr')
+        if index < header_rows:
+            trPr = OxmlElement('w:trPr')
+            trPr.append(OxmlElement('w:tblHeader'))
+            tr.append(trPr)
+        row_tcs = []
+        for entry, col, gridspan, vmerge in cells:
+            tc = deepcopy(tc_template)
+            tcPr = tc[0]
+            if cell_widths or fixed:
+                tcPr[0].set(qn('w:w'), str(sum(twips[col:col + gridspan])))
+            if gridspan > 1:
+                tcPr.append(OxmlElement('w:gridSpan', {qn('w:val'): str(gridspan)}))
+            if vmerge == 'restart':
+                tcPr.append(OxmlElement('w:vMerge', {qn('w:val'): 'restart'}))
+            elif vmerge:
+                tcPr.append(OxmlElement('w:vMerge'))
+            tr.append(tc)
+            row_tcs.append(tc)
+        tbl.append(tr)
+        tcs.append(row_tcs)
+    return tbl, tcs
+
+# characters which append_run_text() writes as elements
+RUN_BREAKS = re.compile(u'([\t\r\n])')
+
+# children of w:pPr which come before w:numPr
+NUMPR_PREDECESSORS = frozenset(qn(tag) for tag in (
+    'w:pStyle', 'w:keepNext', 'w:keepLines', 'w:pageBreakBefore', 'w:framePr',
+    'w:widowControl'))
+
+def new_p(style_id=None):
+    # type: (unicode) -> CT_P
+    """Return a new ``w:p`` element of the paragraph style *style_id*."""
+    p = OxmlElement('w:p')
+    if style_id is not None:
+        pPr = etree.SubElement(p, qn('w:pPr'))
+        etree.SubElement(pPr, qn('w:pStyle'), {qn('w:val'): style_id})
+    return p
+
+def new_r(style_id=None):
+    # type: (unicode) -> CT_R
+    """Return a new ``w:r`` element of the character style *style_id*."""
+    r = OxmlElement('w:r')
+    if style_id is not None:
+        rPr = etree.SubElement(r, qn('w:rPr'))
+        etree.SubElement(rPr, qn('w:rStyle'), {qn('w:val'): style_id})
+    return r
+
+def append_token_runs(p, runs):
+    # type: (CT_P, List[Tuple[unicode, Tuple[unicode, bool, bool]]]) -> None
+    """Append *runs* of ``(text, (color, bold, italic))``, the formats of
+    Pygments token styles, to the ``w:p`` element *p*."""
+    r_tag, rPr_tag = qn('w:r'), qn('w:rPr')
+    for text, (color, bold, italic) in runs:
+        r = etree.SubElement(p, r_tag)
+        if color or bold or italic:
+            rPr = etree.SubElement(r, rPr_tag)
+            if bold:
+                etree.SubElement(rPr, qn('w:b'))
+            if italic:
+                etree.SubElement(rPr, qn('w:i'))
+            if color:
+                etree.SubElement(rPr, qn('w:color'), {qn('w:val'): color.upper()})
+        append_run_text(r, text)
+
+def append_run_text(r, text):
+    # type: (CT_R, unicode) -> None
+    """Append *text* to the ``w:r`` element *r* as python-docx does.
+
+    Tabs become ``w:tab`` and line breaks ``w:br`` elements.
+    """
+    chunks = RUN_BREAKS.split(text) if RUN_BREAKS.search(text) else [text]
+    for index, chunk in enumerate(chunks):
+        if index % 2:
+            etree.SubElement(r, qn('w:tab') if chunk == u'\t' else qn('w:br'))
+        elif chunk:
+            t = etree.SubElement(r, qn('w:t'))
+            t.text = chunk
+            if len(chunk.strip()) < len(chunk):
+                t.set(qn('xml:space'), 'preserve')
+
+def bookmark_name(docname, id):
+    # type: (unicode, unicode) -> unicode
+    """Return the bookmark name of the node *id* of the document *docname*.
+
+    Word limits names to 40 characters; a leading underscore hides the
+    bookmark in its user interface.
+    """
+    key = u'%s#%s' % (docname, id)
+    return '_' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:32]
+
+def insert_bookmark(p, index, bookmark_id, name):
+    # type: (CT_P, int, int, unicode) -> int
+    """Insert the empty bookmark *name* into the ``w:p`` element *p* at
+    *index*. Return the index after it."""
+    start = p.makeelement(qn('w:bookmarkStart'), {qn('w:id'): str(bookmark_id),
+                                                  qn('w:name'): name})
+    end = p.makeelement(qn('w:bookmarkEnd'), {qn('w:id'): str(bookmark_id)})
+    p.insert(index, start)
+    p.insert(index + 1, end)
+    return index + 2
+
+def set_numPr(p, ilvl, numId):
+    # type: (CT_P, int, int) -> None
+    """Set the list level and numbering of the ``w:p`` element *p*."""
+    pPr = p.find(qn('w:pPr'))
+    if pPr is None:
+        pPr = OxmlElement('w:pPr')
+        p.insert(0, pPr)
+    numPr = pPr.find(qn('w:numPr'))
+    if numPr is None:
+        index = 0
+        while index < len(pPr) and pPr[index].tag in NUMPR_PREDECESSORS:
+            index += 1
+        numPr = OxmlElement('w:numPr')
+        etree.SubElement(numPr, qn('w:ilvl'))
+        etree.SubElement(numPr, qn('w:numId'))
+        pPr.insert(index, numPr)
+    numPr.find(qn('w:ilvl')).set(qn('w:val'), str(ilvl))
+    numPr.find(qn('w:numId')).set(qn('w:val'), str(numId))
+
+def strip_nsdecls(xml, nsmap):
+    # type: (bytes, Dict[unicode, unicode]) -> bytes
+    """Remove the namespace declarations of the serialised element *xml*
+    which its parent already makes with *nsmap*."""
+    end = xml.index(b'>')
+    def unused(match):
+        prefix, uri = match.group(1).decode('ascii'), match.group(2).decode('utf-8')
+        return b'' if nsmap.get(prefix) == uri else match.group(0)
+    head = re.sub(br' xmlns:(\w+)="([^"]*)"', unused, xml[:end])
+    return head + xml[end:]
+
+def source_date():
+    # type: () -> datetime
+    """Return the time given by ``SOURCE_DATE_EPOCH`` in UTC, or None."""
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if not epoch:
+        return None
+    return datetime(1970, 1, 1) + timedelta(seconds=int(epoch))
+
+def write_package(filename, package, partname, body=None, compresslevel=None,
+                  date_time=None):
+    # type: (unicode, IO, unicode, IO, int, Tuple[int, ...]) -> None
+    """Write the docx zip *package* to *filename*.
+
+    The blocks serialised to the file *body* are inserted at the start of
+    the body of the document part *partname*, and members are compressed
+    with *compresslevel* where the zipfile module supports it. With
+    *date_time* all members get this timestamp.
+    """
+    kwargs = {}
+    if compresslevel is not None:
+        if sys.version_info >= (3, 7):
+            kwargs['compresslevel'] = int(compresslevel)
+        else:
+            logger.warning('docx_compresslevel needs Python 3.7 or later, ignored')
+    zin = zipfile.ZipFile(package)
+    zout = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, **kwargs)
+    try:
+        for info in zin.infolist():
+            zinfo = zipfile.ZipInfo(info.filename, date_time or info.date_time)
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            zinfo.external_attr = info.external_attr
+            data = zin.read(info)
+            if info.filename != partname or body is None:
+                zout.writestr(zinfo, data, **kwargs)
+                continue
+            if b'<w:body/>' in data:
+                head, tail = data.split(b'<w:body/>', 1)
+                head += b'<w:body>'
+                tail = b'</w:body>' + tail
+            else:
+                head, tail = data.split(b'<w:body>', 1)
+                head += b'<w:body>'
+            body.seek(0)
+            if sys.version_info >= (3, 6):
+                if 'compresslevel' in kwargs:
+                    # open() has no compresslevel argument
+                    zinfo._compresslevel = kwargs['compresslevel']
+                with zout.open(zinfo, 'w') as f:
+                    f.write(head)
+                    shutil.copyfileobj(body, f)
+                    f.write(tail)
+            else:
+                zout.writestr(zinfo, head + body.read() + tail)
+    finally:
+        zout.close()
+        zin.close()
+
+class RelationshipIndex(object):
+    """Relationships of a part, indexed by their targets.
+
+    python-docx finds an existing relationship and the next free rId with
+    linear searches, which is quadratic in the number of links. Here the
+    targets are looked up in a dict and rIds come from a counter.
+    """
+
+    def __init__(self, part):
+        # type: (Part) -> None
+        self.rels = part.rels
+        self.rIds = {}  # type: Dict[Tuple[unicode, Any, bool], unicode]
+        for rId, rel in self.rels.items():
+            target = rel.target_ref if rel.is_external else rel.target_part
+            self.rIds.setdefault((rel.reltype, target, rel.is_external), rId)
+        self.next_rId = 1
+
+    def relate_to(self, target, reltype, is_external=False):
+        # type: (Any, unicode, bool) -> unicode
+        """Return the rId of the relationship to *target*, adding it if needed."""
+        key = (reltype, target, is_external)
+        rId = self.rIds.get(key)
+        if rId is None:
+            while 'rId%d' % self.next_rId in self.rels:
+                self.next_rId += 1
+            rId = 'rId%d' % self.next_rId
+            self.rels.add_relationship(reltype, target, rId, is_external)
+            self.rIds[key] = rId
+        return rId
+
+class NumberingAllocator(object):
+    """Allocate ``w:num`` elements of a numbering part.
+
+    numIds come from a counter and the new elements are inserted into the
+    part in one batch by :meth:`flush`. Numberings which need no restart
+    share one ``w:num`` per abstract numbering.
+    """
+
+    def __init__(self, numbering_part):
+        # type: (NumberingPart) -> None
+        self.numbering = numbering_part.element
+        used = [int(numId) for numId in self.numbering.xpath('./w:num/@w:numId')]
+        self.next_numId = max(used) + 1 if used else 1
+        # numId -> (abstractNumId, restart) of the nums allocated here
+        self.nums = {}  # type: Dict[int, Tuple[int, bool]]
+        self.shared = {}  # type: Dict[int, int]
+        self.pending = []  # type: List[CT_Num]
+
+    def new_num(self, abstractNumId, restart=True):
+        # type: (int, bool) -> int
+        if not restart and abstractNumId in self.shared:
+            return self.shared[abstractNumId]
+        numId = self.next_numId
+        self.next_numId += 1
+        num = CT_Num.new(numId, abstractNumId)
+        if restart:
+            num.add_lvlOverride(ilvl=0).add_startOverride(1)
+        else:
+            self.shared[abstractNumId] = numId
+        self.nums[numId] = (abstractNumId, restart)
+        self.pending.append(num)
+        return numId
+
+    def flush(self):
+        # type: () -> None
+        """Insert the pending ``w:num`` elements into the numbering part."""
+        successor = self.numbering.find(qn('w:numIdMacAtCleanup'))
+        if successor is not None:
+            for num in self.pending:
+                successor.addprevious(num)
+        else:
+            self.numbering.extend(self.pending)
+        self.pending = []
+
+class StyleResolver(object):
+    """Map style names to the style ids of a docx document.
+
+    The styles of the document are read once. A style which is missing or
+    has another type is reported once and replaced by the default style of
+    its type, which is written as no style id at all.
+    """
+
+    def __init__(self, docx):
+        # type: (Document) -> None
+        self.styles = {}  # type: Dict[unicode, Tuple[int, unicode]]
+        for style in docx.styles:
+            style_id = None if style.element.default else style.style_id
+            self.styles[style.name] = (style.type, style_id)
+        self.ids = {}  # type: Dict[Tuple[unicode, int], unicode]
+
+    def get(self, name, style_type):
+        # type: (unicode, int) -> unicode
+        """Return the id of the style *name* of *style_type*, or None."""
+        if name is None:
+            return None
+        key = (name, style_type)
+        try:
+            return self.ids[key]
+        except KeyError:
+            pass
+        found = self.styles.get(name)
+        if found is not None and found[0] == style_type:
+            style_id = found[1]
+        else:
+            logger.warning('style %r (%s) is not defined in the docx style file, '
+                           'using the default style', name, style_type,
+                           type='docx', subtype='style')
+            style_id = None
+        self.ids[key] = style_id
+        return style_id
+
+def get_style_path(builder):
+    # type: (DocxBuilder) -> unicode
+    """Return the path of the docx file used as style template."""
+    stylefile = builder.config.docx_style
+    if stylefile:
+        return os.path.join(builder.srcdir, stylefile)
+    else:
+        return os.path.join(package_dir, 'templates', 'style.docx')
 
 class DocxWriter(writers.Writer):
     supported = ('docx',)
@@ -43,26 +471,24 @@ class DocxWriter(writers.Writer):
     settings_defaults = {}  # type: Dict
 
     output = None
+    stream = None
 
-    def __init__(self, builder):
-        # type: (DocxBuilder) -> None
+    def __init__(self, builder, coreproperties=None):
+        # type: (DocxBuilder, Dict) -> None
         writers.Writer.__init__(self)
         self.builder = builder
 
-        stylefile = builder.config.docx_style
-        if stylefile:
-            style_dir = self.builder.srcdir
-            style_fullpath = os.path.join(style_dir, stylefile)
-            self.docx = Document(style_fullpath)
-        else:
-            style_dir = os.path.join(package_dir, 'templates')
-            style_fullpath = os.path.join(style_dir, 'style.docx')
-            self.docx = Document(style_fullpath)
-        self.docx_set_coreproperties()
-        self.docx._body.clear_content()
-
-    def docx_set_coreproperties(self):
-        new_coreprop = self.builder.config.docx_coreproperties
+        self.docx = template_cache.get(get_style_path(builder))
+        if coreproperties is None:
+            coreproperties = builder.config.docx_coreproperties
+        date = source_date()
+        if builder.config.docx_reproducible and date is not None:
+            coreproperties = dict(coreproperties)
+            coreproperties.setdefault('modified', date)
+        self.docx_set_coreproperties(coreproperties)
+
+    def docx_set_coreproperties(self, new_coreprop):
+        # type: (Dict) -> None
         for name, value in new_coreprop.items():
             setattr(self.docx.core_properties, name, value)
 
@@ -71,9 +497,29 @@ class DocxWriter(writers.Writer):
         visitor = self.builder.create_translator(self.document, self.builder, self.docx)
         self.document.walkabout(visitor)
         self.output = visitor.body
+        self.stream = visitor.stream
 
     def save(self, filename):
-        self.docx.save(filename)
+        compresslevel = self.builder.config.docx_compresslevel
+        reproducible = self.builder.config.docx_reproducible
+        if self.stream is None and compresslevel is None and not reproducible:
+            self.docx.save(filename)
+            return
+        date_time = None
+        if reproducible:
+            date = source_date()
+            date_time = ZIP_EPOCH
+            if date is not None:
+                date_time = max(ZIP_EPOCH, date.timetuple()[:6])
+        package = BytesIO()
+        self.docx.save(package)
+        try:
+            write_package(filename, package, self.docx.part.partname[1:],
+                          self.stream, compresslevel, date_time)
+        finally:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
 
 class DocxTranslator(nodes.NodeVisitor):
 
@@ -81,7 +527,7 @@ class DocxTranslator(nodes.NodeVisitor):
         # paragraph styles
         'title': 'Title',
         'subtitle': 'Subtitle',
-        'heading_': ['Heading %d' % (i+1) for i in range(6)],
+        'heading_': ['Heading %d' % (i+1) for i in range(9)],
         'bullet_list': 'Bullet List',
         'enumerated_list': 'Enumerated List',
         '_empty_bullet_list': 'Empty Bullet List',
@@ -120,10 +566,14 @@ class DocxTranslator(nodes.NodeVisitor):
         self.settings = document.settings
         self.docnames = [builder.current_docname]
         self.docx = docx
+        self.styles = StyleResolver(docx)
+        self.lxml_backend = builder.config.docx_backend == 'lxml'
         self.numbered = 0
         self.numbered_level = 0
         self.section_level = 0
-        self.section_numIds = [self._get_new_num(abstractNumId=12)]
+        self.numbering = NumberingAllocator(docx.part.numbering_part)
+        # numIds of sections are allocated when a heading first needs one
+        self.section_numIds = [None]
         self.initial_header_level = 0  # int(self.settings.initial_header_level)
         # docx paragraph properties
         self.p = None
@@ -135,77 +585,411 @@ class DocxTranslator(nodes.NodeVisitor):
         # special paragraphs
         self.tables = []
         self.item_width_rate = 0.8
+        # the section is not changed, and looking it up searches the document
+        self.block_width = docx._block_width
         # docx run properties
         self.r = None
         self.r_style = None
+        # text waiting to be written as one run: (paragraph, style, pieces)
+        self.pending_run = None
+        self.run_overhead = {}  # type: Dict[unicode, int]
+        # images are loaded by worker threads while the document is translated
+        self.rels = RelationshipIndex(docx.part)
+        self.pictures = PictureFactory(docx, self.rels)
+        # w:hyperlink element which receives the runs of a reference
+        self.hyperlink = None
+        # bookmark names by (docname, node id), see DocxBuilder.index_bookmarks
+        self.bookmarks = builder.bookmarks
+        self.pending_bookmarks = []  # type: List[unicode]
+        self.next_bookmark_id = 0
+        self.images = ImageLoader(int(builder.config.docx_image_threads),
+                                  self.block_width, builder.image_optimizer,
+                                  builder.media)
+        self.images.prefetch(
+            os.path.join(builder.srcdir, image['uri'])
+            for image in document.traverse(nodes.image)
+            if not isinstance(image.parent, nodes.substitution_definition)
+            and image_mimetype(image['uri']) in builder.supported_image_types)
+        if builder.highlighter is not None:
+            builder.highlighter.prefetch(document.traverse(nodes.literal_block))
+        # completed body blocks are serialised here in streaming mode
+        self.stream = None
+        if builder.config.docx_streaming:
+            self.stream = tempfile.TemporaryFile()
+        # chapters being recorded into the fragment cache
+        self.fragments = []
+        self.fragment_keys = []
 
     def _fignum_prefix(self, node):
-        prefix = ''
-        if self.builder.config.numfig:
-            figtype = self.builder.env.domains['std'].get_figtype(node)
-            format = self.builder.config.numfig_format.get(figtype)
-            alias = u'%s/%s' % (self.docnames[-1], figtype)
-            id = node['ids'][0]
-            nums = self.builder.fignumbers[alias][id]
-            prefix = format % '.'.join(map(str, nums))
-        return prefix
+        # type: (nodes.Node) -> unicode
+        """Return the number prefix of the caption of *node*, '' if it has none."""
+        if not node['ids']:
+            return ''
+        return self.builder.fignum_prefixes.get((self.docnames[-1], node['ids'][0]), '')
+
+    def _new_paragraph(self, parent, text=None, style=None):
+        # type: (Any, unicode, unicode) -> Paragraph
+        """Add a paragraph of the style *style* to *parent*.
+
+        Pending bookmarks are placed at its start.
+        """
+        style_id = self.styles.get(style, WD_STYLE_TYPE.PARAGRAPH)
+        if self.lxml_backend:
+            p = new_p(style_id)
+            self._insert_bookmarks(p, len(p))
+            if text:
+                r = new_r()
+                append_run_text(r, text)
+                p.append(r)
+            if parent is self.docx:
+                self._insert_block(p)
+                return Paragraph(p, self.docx._body)
+            parent._element.append(p)
+            return Paragraph(p, parent)
+        p = parent.add_paragraph(text)
+        if style_id is not None:
+            p._p.style = style_id
+        self._insert_bookmarks(p._p, 0 if p._p.pPr is None else 1)
+        return p
+
+    def _insert_bookmarks(self, p, index):
+        # type: (CT_P, int) -> None
+        """Insert the pending bookmarks into the ``w:p`` element *p* at *index*."""
+        for name in self.pending_bookmarks:
+            index = insert_bookmark(p, index, self.next_bookmark_id, name)
+            self.next_bookmark_id += 1
+        self.pending_bookmarks = []
+
+    def dispatch_visit(self, node):
+        # type: (nodes.Node) -> None
+        if isinstance(node, nodes.Element) and node.get('ids'):
+            docname = self.docnames[-1]
+            for id in node['ids']:
+                name = self.bookmarks.get((docname, id))
+                if name is not None and name not in self.pending_bookmarks:
+                    self.pending_bookmarks.append(name)
+            if isinstance(node, nodes.Inline) and self.p is not None:
+                # inline targets are marked where they are
+                self._flush_run()
+                self._insert_bookmarks(self.p._p, len(self.p._p))
+        return nodes.NodeVisitor.dispatch_visit(self, node)
 
     def _add_paragraph(self, text=None, style=None):
-        p = None
-        try:
-            if isinstance(style, list):
-                p = self.p_parents[-1].add_paragraph(text, style[-1])
-            else:
-                p = self.p_parents[-1].add_paragraph(text, style)
-        except:
-            p = self.p_parents[-1].add_paragraph(text, 'Normal')
+        if isinstance(style, list):
+            style = style[-1] if style else None
+        p = self._new_paragraph(self.p_parents[-1], text, style)
         if self.p_level > 0:
             self._multilevel_list_numbering(p, self.p_level - 1, 15)
         return p
 
-    def _add_run(self, text=None, style=None):
-        r = None
-        if self.p:
-            try:
-                r = self.p.add_run(text, style)
-            except:
-                r = self.p.add_run(text, 'Default Paragraph Font')
-        return r
+    def _add_run(self, text, style=None):
+        """Add *text* to the current paragraph.
 
-    def _get_new_num(self, abstractNumId):
-        # monkey patch
-        from types import MethodType
-        from docx.parts.numbering import _NumberingDefinitions
-        from docx.oxml.numbering import CT_Num
-        from docx.oxml.numbering import CT_Numbering
-        def add_num(self, abstractNum_id, restart=False):
-            next_num_id = self._next_numId
-            num = CT_Num.new(next_num_id, abstractNum_id)
-            if restart:
-                num.add_lvlOverride(ilvl=0).add_startOverride(1)
-            return self._insert_num(num)
-        numbering = self.docx._part.numbering_part.numbering_definitions._numbering
-        if sys.version_info.major >= 3:
-            numbering.add_num = MethodType(add_num, numbering)
+        Adjacent texts of the same style are buffered and written as a single
+        run by :meth:`_flush_run`.
+        """
+        if not self.p:
+            return
+        pending = self.pending_run
+        if pending is not None and pending[0]._p is self.p._p and pending[1] == style:
+            pending[2].append(text)
         else:
-            numbering.add_num = MethodType(add_num, numbering, CT_Numbering)
-        num = numbering.add_num(abstractNumId, True).numId
-        return num
+            self._flush_run()
+            self.pending_run = (self.p, style, [text])
+
+    def _flush_run(self):
+        # type: () -> None
+        """Write the buffered text as a run."""
+        if self.pending_run is None:
+            return
+        p, style, pieces = self.pending_run
+        self.pending_run = None
+        style_id = self.styles.get(style, WD_STYLE_TYPE.CHARACTER)
+        if self.lxml_backend:
+            r = new_r(style_id)
+            p._p.append(r)
+        else:
+            run = p.add_run()
+            r = run._r
+            if style_id is not None:
+                r.style = style_id
+        if self.hyperlink is not None and self.hyperlink.getparent() is p._p:
+            self.hyperlink.append(r)
+        if len(pieces) > 1:
+            # size of the markup of the runs which are saved by merging
+            if style not in self.run_overhead:
+                xml = re.sub(br' xmlns:\w+="[^"]*"', b'', etree.tostring(r))
+                self.run_overhead[style] = len(xml) + len(b'<w:t></w:t>')
+            self.builder.merged_runs += len(pieces) - 1
+            self.builder.merged_bytes += (len(pieces) - 1) * self.run_overhead[style]
+        if self.lxml_backend:
+            append_run_text(r, ''.join(pieces))
+        else:
+            run.text = ''.join(pieces)
+
+    def _section_numId(self, index):
+        # type: (int) -> int
+        """Return the numId of a section on the stack, allocating it on first use."""
+        if self.section_numIds[index] is None:
+            self.section_numIds[index] = self.numbering.new_num(abstractNumId=12)
+        return self.section_numIds[index]
 
     def _multilevel_list_numbering(self, paragraph, ilvl, numId):
+        if self.lxml_backend:
+            set_numPr(paragraph._p, ilvl, numId)
+            return
         # monkey patch
         pfmt = paragraph.paragraph_format
         numPr = pfmt._element.get_or_add_pPr().get_or_add_numPr()
         numPr.get_or_add_ilvl().val = ilvl
         numPr.get_or_add_numId().val = numId
 
+    def _last_block(self):
+        # type: () -> etree._Element
+        body = self.docx.element.body
+        try:
+            block = body[-1]
+        except IndexError:
+            return None
+        if block.tag == qn('w:sectPr'):
+            block = block.getprevious()
+        return block
+
+    def _insert_block(self, block):
+        # type: (etree._Element) -> None
+        body = self.docx.element.body
+        # body.sectPr searches all the blocks; the sectPr can only be last
+        try:
+            last = body[-1]
+        except IndexError:
+            last = None
+        if last is not None and last.tag == qn('w:sectPr'):
+            last.addprevious(block)
+        else:
+            body.append(block)
+
+    def _add_page_break(self):
+        # type: () -> bool
+        """Add a page break at the end of the last block of the body.
+
+        Return False if the last block is a table, which cannot hold the
+        break; the caller then sets page break before on its next paragraph.
+        """
+        self._flush_run()
+        block = self._last_block()
+        if block is None:
+            return True
+        if block.tag != qn('w:p'):
+            return False
+        Paragraph(block, self.docx._body).add_run().add_break(WD_BREAK.PAGE)
+        # the break belongs to the chapters which have no block yet
+        for fragment in self.fragments:
+            if block is fragment['anchor']:
+                fragment['leading_break'] = True
+        return True
+
+    def _fragment_context(self):
+        # type: () -> List[unicode]
+        for index in range(len(self.section_numIds)):
+            self._section_numId(index)
+        return [str(numId) for numId in self.section_numIds + self.numIds]
+
+    def _fragment_key(self, node):
+        # type: (nodes.Node) -> unicode
+        """Return the fragment cache key of the chapter *node*, or None.
+
+        Only chapters placed directly in the body can be cached.
+        """
+        if (self.builder.fragment_cache is None or self.p is not None or
+                len(self.p_parents) > 1 or self.tables or self.pending_bookmarks):
+            return None
+        docnames = set()
+        images = []
+        # internal references link only to the targets in this output file
+        anchors = []
+        for subnode in node.traverse(lambda n: isinstance(n, (addnodes.start_of_file,
+                                                              nodes.image, nodes.reference))):
+            if isinstance(subnode, nodes.reference):
+                anchors.append(self._anchor(subnode, self._docname_of(subnode)))
+            elif isinstance(subnode, nodes.image):
+                image_fullpath = os.path.join(self.builder.srcdir, subnode['uri'])
+                try:
+                    stat = os.stat(image_fullpath)
+                    images.append((subnode['uri'], stat.st_mtime, stat.st_size))
+                except OSError:
+                    images.append((subnode['uri'], None, None))
+            else:
+                docnames.add(subnode['docname'])
+        fignumbers = sorted(item for item in self.builder.fignum_prefixes.items()
+                            if item[0][0] in docnames)
+        state = (self.section_level, self.numbered, self.numbered_level,
+                 self.initial_header_level, self.p_level, list(self.p_style),
+                 len(self.section_numIds), len(self.numIds),
+                 self.is_first_list_item, self.r_style, list(self.docnames))
+        sha1 = hashlib.sha1()
+        sha1.update(repr((FRAGMENT_VERSION, self.builder.get_fragment_digest(),
+                          state, fignumbers, images, anchors)).encode('utf-8'))
+        sha1.update(node.pformat().encode('utf-8'))
+        return sha1.hexdigest()
+
+    def _stream_blocks(self, final=False):
+        # type: (bool) -> None
+        """Move the completed blocks of the body to the stream.
+
+        The last block is kept for page breaks unless this is the *final*
+        call, and nothing is moved while a paragraph or table is open.
+        """
+        if self.stream is None:
+            return
+        if not final and (self.p is not None or len(self.p_parents) > 1 or self.tables):
+            return
+        self._flush_run()
+        body = self.docx.element.body
+        root_nsmap = self.docx.element.nsmap
+        last = None if final else self._last_block()
+        while len(body) and body[0] is not last and body[0].tag != qn('w:sectPr'):
+            block = body[0]
+            for fragment in self.fragments:
+                if fragment['started']:
+                    fragment['streamed'].append(block)
+                elif block is fragment['anchor']:
+                    fragment['started'] = True
+            body.remove(block)
+            self.stream.write(strip_nsdecls(etree.tostring(block, encoding='utf-8'), root_nsmap))
+
+    def _start_fragment(self, key):
+        # type: (unicode) -> None
+        anchor = self._last_block()
+        self.fragments.append({
+            'key': key,
+            'anchor': anchor,
+            # blocks of the chapter already moved to the stream
+            'started': anchor is None,
+            'streamed': [],
+            'context': self._fragment_context(),
+            'leading_break': False,
+        })
+
+    def _finish_fragment(self):
+        # type: () -> None
+        """Store the blocks translated since :meth:`_start_fragment`."""
+        fragment = self.fragments.pop()
+        cache = self.builder.fragment_cache
+        if fragment['started']:
+            block = next(iter(self.docx.element.body), None)
+        else:
+            block = fragment['anchor'].getnext()
+        blocks = fragment['streamed']
+        while block is not None and block.tag != qn('w:sectPr'):
+            blocks.append(block)
+            block = block.getnext()
+        rels = self.docx.part.rels
+        nums = {}
+        relinfo = {}
+        rel_attrs = '{%s}' % nsmap['r']
+        for block in blocks:
+            for numId in block.iter(qn('w:numId')):
+                val = numId.get(qn('w:val'))
+                num = self.numbering.nums.get(int(val))
+                if num is not None and val not in fragment['context']:
+                    nums[val] = num
+            for element in block.iter():
+                for attr, rId in element.attrib.items():
+                    if not attr.startswith(rel_attrs) or rId in relinfo:
+                        continue
+                    rel = rels[rId]
+                    if rel.is_external:
+                        relinfo[rId] = ('external', rel.reltype, rel.target_ref)
+                    elif rel.reltype == RT.IMAGE:
+                        blob = rel.target_part.blob
+                        sha1 = hashlib.sha1(blob).hexdigest()
+                        if 'blob-' + sha1 not in cache:
+                            cache.set('blob-' + sha1, blob)
+                        relinfo[rId] = ('image', rel.reltype, sha1)
+                    else:
+                        # not reproducible from the cache
+                        return
+        cache.set(fragment['key'], {
+            'blocks': [etree.tostring(block) for block in blocks],
+            'nums': nums,
+            'context': fragment['context'],
+            'rels': relinfo,
+            'leading_break': fragment['leading_break'],
+        })
+
+    def _insert_fragment(self, key):
+        # type: (unicode) -> bool
+        """Insert the cached chapter *key* remapping its ids. Return success."""
+        cache = self.builder.fragment_cache
+        fragment = cache.get(key)
+        if fragment is None:
+            return False
+        blobs = {}
+        for rId, (kind, reltype, target) in fragment['rels'].items():
+            if kind == 'image':
+                blobs[target] = cache.get('blob-' + target)
+                if blobs[target] is None:
+                    return False
+        pagebreak = fragment['leading_break'] and not self._add_page_break()
+        # numbering: inherited ids map to the current context, own ids are renewed
+        nummap = dict(zip(fragment['context'], self._fragment_context()))
+        for numId, (abstractNumId, restart) in sorted(fragment['nums'].items()):
+            nummap[numId] = str(self.numbering.new_num(abstractNumId, restart))
+        relmap = {}
+        for rId, (kind, reltype, target) in fragment['rels'].items():
+            if kind == 'external':
+                relmap[rId] = self.rels.relate_to(target, reltype, is_external=True)
+            else:
+                relmap[rId] = self.pictures.relate_image(Image.from_blob(blobs[target]))
+        rel_attrs = '{%s}' % nsmap['r']
+        bookmark_ids = {}  # type: Dict[unicode, unicode]
+        for block_xml in fragment['blocks']:
+            block = parse_xml(block_xml)
+            for element in block.iter():
+                if element.tag == qn('w:numId'):
+                    val = element.get(qn('w:val'))
+                    element.set(qn('w:val'), nummap.get(val, val))
+                elif element.tag == qn('wp:docPr'):
+                    element.set('id', str(self.pictures.new_shape_id()))
+                elif element.tag == qn('w:bookmarkStart'):
+                    bookmark_ids[element.get(qn('w:id'))] = str(self.next_bookmark_id)
+                    self.next_bookmark_id += 1
+                    element.set(qn('w:id'), bookmark_ids[element.get(qn('w:id'))])
+                elif element.tag == qn('w:bookmarkEnd'):
+                    element.set(qn('w:id'), bookmark_ids[element.get(qn('w:id'))])
+                for attr, rId in element.attrib.items():
+                    if attr.startswith(rel_attrs):
+                        element.set(attr, relmap[rId])
+            if pagebreak and block.tag == qn('w:p'):
+                Paragraph(block, self.docx._body).paragraph_format.page_break_before = True
+            pagebreak = False
+            self._insert_block(block)
+        return True
+
     def visit_start_of_file(self, node):
         # type: (nodes.Node) -> None
+        self._flush_run()
+        key = self._fragment_key(node)
+        if key is not None:
+            if self._insert_fragment(key):
+                self.builder.fragment_hits += 1
+                raise nodes.SkipNode
+            self.builder.fragment_misses += 1
+            self._start_fragment(key)
+        self.fragment_keys.append(key)
         self.docnames.append(node['docname'])
 
     def depart_start_of_file(self, node):
         # type: (nodes.Node) -> None
+        self._flush_run()
+        if self.pending_bookmarks:
+            # targets at the end of the file mark its last paragraph
+            block = self._last_block()
+            if block is not None and block.tag == qn('w:p'):
+                self._insert_bookmarks(block, len(block))
         self.docnames.pop()
+        if self.fragment_keys.pop() is not None:
+            self._finish_fragment()
 
     def visit_document(self, node):
         # type: (nodes.Node) -> None
@@ -213,6 +997,10 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def depart_document(self, node):
         # type: (nodes.Node) -> None
+        self._flush_run()
+        self.numbering.flush()
+        self._stream_blocks(final=True)
+        self.images.close()
         self.body = 'dommy text'
 
     def visit_highlightlang(self, node):
@@ -221,10 +1009,10 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def visit_section(self, node):
         # type: (nodes.Node) -> None
+        self._stream_blocks()
         self.section_level += 1
         if self.numbered:
-            numId = self._get_new_num(abstractNumId=12)
-            self.section_numIds.append(numId)
+            self.section_numIds.append(None)
 
     def depart_section(self, node):
         # type: (nodes.Node) -> None
@@ -287,18 +1075,24 @@ class DocxTranslator(nodes.NodeVisitor):
             self.p = self._add_paragraph(prefix + ' ', style=self.stylename['table_caption'])
             self.p.paragraph_format.keep_with_next = True
         elif isinstance(node.parent, nodes.document):
-            self.docx.add_heading(node.astext().replace('\n', ' '), 0)
+            self._new_paragraph(self.docx, node.astext().replace('\n', ' '),
+                                self.stylename['title'])
         elif isinstance(node.parent, nodes.section):
             headinglevel = self.section_level + self.initial_header_level - 1
             breaklevel = self.builder.config.docx_pagebreak_level
+            pagebreak = False
             if breaklevel is not None and headinglevel <= breaklevel:
-                lastp = self.docx.paragraphs[-1] if len(self.docx.paragraphs) > 0 else None
-                if lastp:
-                    lastp.add_run().add_break(WD_BREAK.PAGE)
-            p = self.docx.add_heading(node.astext().replace('\n', ' '), headinglevel)
+                pagebreak = not self._add_page_break()
+            if headinglevel == 0:
+                style = self.stylename['title']
+            else:
+                style = self.stylename['heading_'][headinglevel - 1]
+            p = self._new_paragraph(self.docx, node.astext().replace('\n', ' '), style)
+            if pagebreak:
+                p.paragraph_format.page_break_before = True
             secnumlevel = self.section_level - self.numbered_level
             if self.numbered and self.numbered > secnumlevel - 1:
-                self._multilevel_list_numbering(p, secnumlevel - 1, self.section_numIds[-2])
+                self._multilevel_list_numbering(p, secnumlevel - 1, self._section_numId(-2))
         else:
             pass
 
@@ -350,7 +1144,6 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def visit_desc_name(self, node):
         # type: (nodes.Node) -> None
-        self.r = self.p.add_run()
         self.r_style = self.stylename['strong']
 
     def depart_desc_name(self, node):
@@ -386,11 +1179,11 @@ class DocxTranslator(nodes.NodeVisitor):
         # type: (nodes.Node) -> None
         params = [child.astext() for child in node.children]
         text = '(' + ', '.join(params) + ')'
-        self.r = self.p.add_run(text)
+        self._add_run(text)
 
     def depart_desc_parameterlist(self, node):
         # type: (nodes.Node) -> None
-        self.r = None
+        pass
 
     def visit_desc_parameter(self, node):
         # type: (nodes.Node) -> None
@@ -486,14 +1279,7 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def visit_option_list(self, node):
         # type: (nodes.Node) -> None
-        self._add_paragraph_between_table(node)
-        item_num = len(node.children)
-        table = self.p_parents[-1].add_table(rows=item_num, cols=2)
-        twidth = sum([cell.width for cell in table.row_cells(0)])
-        for i in range(item_num):
-            table.column_cells(0)[i].width = int(twidth * (1 - self.item_width_rate))
-            table.column_cells(1)[i].width = int(twidth * (self.item_width_rate))
-        self.tables.append([table, 0, 0])
+        self._add_item_table(node)
 
     def depart_option_list(self, node):
         # type: (nodes.Node) -> None
@@ -505,23 +1291,16 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def depart_option_list_item(self, node):
         # type: (nodes.Node) -> None
-        self.tables[-1][1] += 1
-        self.tables[-1][2] = 0
+        pass
 
     def visit_option_group(self, node):
         # type: (nodes.Node) -> None
-        row = self.tables[-1][1]
-        col = self.tables[-1][2]
-        table = self.tables[-1][0]
-        cell = table.cell(row, col)
-        self.p_parents.append(cell)
-        self.p = cell.paragraphs[0]
+        self._enter_cell(node)
 
     def depart_option_group(self, node):
         # type: (nodes.Node) -> None
         self.p = None
         self.p_parents.pop()
-        self.tables[-1][2] += 1
 
     def visit_option(self, node):
         # type: (nodes.Node) -> None
@@ -549,18 +1328,12 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def visit_description(self, node):
         # type: (nodes.Node) -> None
-        row = self.tables[-1][1]
-        col = self.tables[-1][2]
-        table = self.tables[-1][0]
-        cell = table.cell(row, col)
-        self.p_parents.append(cell)
-        self.p = cell.paragraphs[0]
+        self._enter_cell(node)
 
     def depart_description(self, node):
         # type: (nodes.Node) -> None
         self.p = None
         self.p_parents.pop()
-        self.tables[-1][2] += 1
 
     def visit_tabular_col_spec(self, node):
         # type: (nodes.Node) -> None
@@ -570,14 +1343,75 @@ class DocxTranslator(nodes.NodeVisitor):
         # type: (nodes.Node) -> None
         raise nodes.SkipNode
 
+    def _add_table(self, layout, cols, header_rows=0, colwidths=None, fixed=False):
+        # type: (List[List[Tuple[nodes.Node, int, int, unicode]]], int, int, List[float], bool) -> Tuple[Table, Dict[nodes.Node, _Cell]]
+        """Add a table laid out by :func:`table_layout` to the current parent.
+
+        *colwidths* are relative widths of the columns, which then fill the
+        width of the parent. Return the table and the cells of the entries.
+        """
+        parent = self.p_parents[-1]
+        if parent is self.docx:
+            width = self.block_width
+        else:
+            width = parent.width if parent.width is not None else Inches(1)
+        if colwidths:
+            total = float(sum(colwidths))
+            grid_widths = [int(width * colwidth / total) for colwidth in colwidths]
+        else:
+            grid_widths = [int(width / cols)] * cols
+        tbl, tcs = new_tbl(layout, grid_widths, header_rows,
+                           cell_widths=bool(colwidths), fixed=fixed)
+        if parent is self.docx:
+            self._insert_block(tbl)
+            table = Table(tbl, self.docx._body)
+        else:
+            # Word requires a paragraph as the last element of a cell
+            parent._tc.append(tbl)
+            parent._tc.append(OxmlElement('w:p'))
+            table = Table(tbl, parent)
+        cells = {}
+        for layout_row, row_tcs in zip(layout, tcs):
+            for (entry, col, gridspan, vmerge), tc in zip(layout_row, row_tcs):
+                if entry is not None:
+                    cells[entry] = _Cell(tc, table)
+        return table, cells
+
+    def _enter_cell(self, node):
+        # type: (nodes.Node) -> None
+        cell = self.tables[-1][1][node]
+        self.p_parents.append(cell)
+        self.p = cell.paragraphs[0]
+
+    def _add_item_table(self, node):
+        # type: (nodes.Node) -> None
+        """Add a two column table for the items of a field or option list."""
+        self._add_paragraph_between_table(node)
+        layout = table_layout(node.children, 2)
+        colwidths = [1 - self.item_width_rate, self.item_width_rate]
+        self.tables.append(self._add_table(layout, 2, colwidths=colwidths))
+
     def visit_tgroup(self, node):
         # type: (nodes.Node) -> None
         tgroup_node = node
-        thead_num = len(tgroup_node.children[-2].children)
-        tbody_num = len(tgroup_node.children[-1].children)
-        row_num = thead_num + tbody_num
+        rows = []
+        thead_num = 0
+        for child in tgroup_node.children:
+            if isinstance(child, nodes.thead):
+                thead_num = len(child.children)
+            if isinstance(child, (nodes.thead, nodes.tbody)):
+                rows.extend(child.children)
         col_num = tgroup_node['cols']
-        table = self.p_parents[-1].add_table(rows=row_num, cols=col_num)
+        layout = table_layout(rows, col_num)
+        colwidths = None
+        if self.builder.config.docx_table_layout == 'fixed':
+            colwidths = [colspec.get('colwidth') for colspec in tgroup_node.children
+                         if isinstance(colspec, nodes.colspec)]
+            if ('colwidths-auto' in tgroup_node.parent['classes'] or
+                    len(colwidths) != col_num or not all(colwidths)):
+                colwidths = estimate_colwidths(layout, col_num)
+        table, cells = self._add_table(layout, col_num, header_rows=thead_num,
+                                       colwidths=colwidths, fixed=bool(colwidths))
         align = tgroup_node.parent.get('align')
         if not align:
             align = self.builder.config.docx_imagetable_align
@@ -588,19 +1422,12 @@ class DocxTranslator(nodes.NodeVisitor):
                 table.alignment = WD_TABLE_ALIGNMENT.CENTER
             elif align == 'right':
                 table.alignment = WD_TABLE_ALIGNMENT.RIGHT
-        for raw in table.rows:
-            for c in raw._tr.tc_lst:
-                tcW = c.tcPr.tcW
-                tcW.type = 'auto'
-                tcW.w = 0
         if thead_num == 0:
-            table.style = self.stylename['table'][0]
+            style = self.stylename['table'][0]
         else:
-            table.style = self.stylename['table'][1]
-            for i in range(thead_num):
-                trPr = table.rows[i]._tr.get_or_add_trPr()
-                tblHeader = trPr.get_or_add_tblHeader()
-        self.tables.append([table, 0, 0])
+            style = self.stylename['table'][1]
+        table._tbl.tblStyle_val = self.styles.get(style, WD_STYLE_TYPE.TABLE)
+        self.tables.append((table, cells))
 
     def depart_tgroup(self, node):
         # type: (nodes.Node) -> None
@@ -628,43 +1455,15 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def depart_row(self, node):
         # type: (nodes.Node) -> None
-        self.tables[-1][1] += 1
-        self.tables[-1][2] = 0
+        pass
 
     def visit_entry(self, node):
         # type: (nodes.Node) -> None
-        row = self.tables[-1][1]
-        col = self.tables[-1][2]
-        table = self.tables[-1][0]
-        cell = table.cell(row, col)
-        self.p_parents.append(cell)
-        self.p = cell.paragraphs[0]
-        if 'morerows' in node or 'morecols' in node:
-            mrow = node.get('morerows', 0)
-            mcol = node.get('morecols', 0)
-            cell.merge(table.cell(row + mrow, col + mcol))
+        self._enter_cell(node)
 
     def depart_entry(self, node):
         # type: (nodes.Node) -> None
         self.p_parents.pop()
-        self.tables[-1][2] += 1
-        col = self.tables[-1][2]
-        row = self.tables[-1][1]
-        table = self.tables[-1][0]
-        if row > 0:
-            for x in range(col + 1, len(table.rows[row].cells) - 1):
-                head = table.cell(row - 1, x)
-                now = table.cell(row, x)
-                if head._tc != now._tc:
-                    break
-                self.tables[-1][2] += 1
-        col = self.tables[-1][2]
-        for x in range(col, len(table.rows[row].cells) - 1):
-            next1 = table.cell(row, x - 1)
-            next2 = table.cell(row, x)
-            if next1._tc != next2._tc:
-                break
-            self.tables[-1][2] += 1
 
     def _add_paragraph_between_table(self, node):
         index = node.parent.index(node)
@@ -672,7 +1471,7 @@ class DocxTranslator(nodes.NodeVisitor):
         if (isinstance(prev_node, nodes.table)
             or isinstance(prev_node, nodes.field_list)
             or isinstance(prev_node, nodes.option_list)):
-            self.docx.add_paragraph('')
+            self._new_paragraph(self.docx, '')
 
     def visit_table(self, node):
         # type: (nodes.Node) -> None
@@ -680,7 +1479,7 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def depart_table(self, node):
         # type: (nodes.Node) -> None
-        pass
+        self._stream_blocks()
 
     def visit_acks(self, node):
         # type: (nodes.Node) -> None
@@ -698,18 +1497,24 @@ class DocxTranslator(nodes.NodeVisitor):
         if 'scale' in node:
             pass
         image_fullpath = os.path.join(self.builder.srcdir, uri)
-        block_width = self.docx._block_width
         if isinstance(node.parent, nodes.substitution_definition):
             pass
+        elif image_mimetype(uri) not in self.builder.supported_image_types:
+            # post_process_images() only warns about images given with '.*'
+            if '*' in node['candidates']:
+                logger.warning('no image converter for %s is available', uri,
+                               location=node)
         else:
+            image, cx, cy = self.images.get(image_fullpath)
+            name = os.path.basename(image_fullpath)
             if isinstance(node.parent, nodes.paragraph):
-                pic = self.r.add_picture(image_fullpath)
+                self._flush_run()
+                self.pictures.add_picture(self.p.add_run(), image, cx, cy, name)
             elif isinstance(node.parent, nodes.figure):
-                pic = self.r.add_picture(image_fullpath)
+                self.pictures.add_picture(self.r, image, cx, cy, name)
             else:
                 p = self._add_paragraph()
-                r = p.add_run()
-                pic = r.add_picture(image_fullpath)
+                self.pictures.add_picture(p.add_run(), image, cx, cy, name)
                 align = node.get('align')
                 if not align:
                     align = self.builder.config.docx_imagetable_align
@@ -720,22 +1525,20 @@ class DocxTranslator(nodes.NodeVisitor):
                         p.alignment = WD_TABLE_ALIGNMENT.CENTER
                     elif align == 'right':
                         p.alignment = WD_TABLE_ALIGNMENT.RIGHT
-            if pic.width > block_width:
-                pic.height = int(pic.height * float(block_width) / pic.width)
-                pic.width = block_width
         raise nodes.SkipNode
 
     def visit_transition(self, node):
         # type: (nodes.Node) -> None
         # TODO: change from style to image
-        self.docx.add_paragraph('', style=self.stylename['transition'])
+        self._new_paragraph(self.docx, '', self.stylename['transition'])
         self.p = None
         raise nodes.SkipNode
 
     def visit_bullet_list(self, node):
         # type: (nodes.Node) -> None
         self.p_level += 1
-        numId = self._get_new_num(abstractNumId=11)
+        # bullets look the same whether or not they restart
+        numId = self.numbering.new_num(abstractNumId=11, restart=False)
         self.numIds.append(numId)
 
     def depart_bullet_list(self, node):
@@ -746,7 +1549,7 @@ class DocxTranslator(nodes.NodeVisitor):
     def visit_enumerated_list(self, node):
         # type: (nodes.Node) -> None
         self.p_level += 1
-        numId = self._get_new_num(abstractNumId=15)
+        numId = self.numbering.new_num(abstractNumId=15)
         self.numIds.append(numId)
 
     def depart_enumerated_list(self, node):
@@ -806,14 +1609,7 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def visit_field_list(self, node):
         # type: (nodes.Node) -> None
-        self._add_paragraph_between_table(node)
-        item_num = len(node.children)
-        table = self.p_parents[-1].add_table(rows=item_num, cols=2)
-        twidth = sum([cell.width for cell in table.row_cells(0)])
-        for i in range(item_num):
-            table.column_cells(0)[i].width = int(twidth * (1 - self.item_width_rate))
-            table.column_cells(1)[i].width = int(twidth * (self.item_width_rate))
-        self.tables.append([table, 0, 0])
+        self._add_item_table(node)
 
     def depart_field_list(self, node):
         # type: (nodes.Node) -> None
@@ -825,38 +1621,25 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def depart_field(self, node):
         # type: (nodes.Node) -> None
-        self.tables[-1][1] += 1
-        self.tables[-1][2] = 0
+        pass
 
     def visit_field_name(self, node):
         # type: (nodes.Node) -> None
-        row = self.tables[-1][1]
-        col = self.tables[-1][2]
-        table = self.tables[-1][0]
-        cell = table.cell(row, col)
-        self.p_parents.append(cell)
-        self.p = cell.paragraphs[0]
+        self._enter_cell(node)
 
     def depart_field_name(self, node):
         # type: (nodes.Node) -> None
         self.p = None
         self.p_parents.pop()
-        self.tables[-1][2] += 1
 
     def visit_field_body(self, node):
         # type: (nodes.Node) -> None
-        row = self.tables[-1][1]
-        col = self.tables[-1][2]
-        table = self.tables[-1][0]
-        cell = table.cell(row, col)
-        self.p_parents.append(cell)
-        self.p = cell.paragraphs[0]
+        self._enter_cell(node)
 
     def depart_field_body(self, node):
         # type: (nodes.Node) -> None
         self.p = None
         self.p_parents.pop()
-        self.tables[-1][2] += 1
 
     def visit_centered(self, node):
         # type: (nodes.Node) -> None
@@ -902,6 +1685,13 @@ class DocxTranslator(nodes.NodeVisitor):
         # type: (nodes.Node) -> None
         self.p_style.append(self.stylename['literal_block'])
         self.p = self._add_paragraph(style=self.p_style[-1])
+        runs = None
+        if self.builder.highlighter is not None:
+            runs = self.builder.highlighter.get(node)
+        if runs is not None:
+            append_token_runs(self.p._p, runs)
+            self.depart_literal_block(node)
+            raise nodes.SkipNode
 
     def depart_literal_block(self, node):
         # type: (nodes.Node) -> None
@@ -963,12 +1753,12 @@ class DocxTranslator(nodes.NodeVisitor):
             else:
                 self._multilevel_list_numbering(self.p, self.p_level - 1, 15)
             self.is_first_list_item = False
-        self.r = self.p.add_run()
 
     def depart_paragraph(self, node):
         # type: (nodes.Node) -> None
-        self.r = None
+        self._flush_run()
         self.p = None
+        self._stream_blocks()
 
     def visit_target(self, node):
         # type: (nodes.Node) -> None
@@ -996,18 +1786,57 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def visit_reference(self, node):
         # type: (nodes.Node) -> None
-        # TODO: add hyperlink
         self.r_style = self.stylename['reference']
-        self.r = self.p.add_run(style=self.r_style)
+        if self.p is None:
+            return
+        refuri = node.get('refuri')
+        if 'refid' in node or refuri and refuri.startswith('%'):
+            attrs = {qn('w:anchor'): self._anchor(node, self.docnames[-1])}
+        elif refuri and not node.get('internal'):
+            attrs = {qn('r:id'): self.rels.relate_to(refuri, RT.HYPERLINK, is_external=True)}
+        else:
+            return
+        if None in attrs.values():
+            # the target is not in this file
+            return
+        attrs[qn('w:history')] = '1'
+        self._flush_run()
+        self.hyperlink = etree.SubElement(self.p._p, qn('w:hyperlink'), attrs)
+
+    def _anchor(self, node, docname):
+        # type: (nodes.Node, unicode) -> unicode
+        """Return the bookmark name of the target of the internal reference
+        *node* in the document *docname*, or None."""
+        if 'refid' in node:
+            return self.bookmarks.get((docname, node['refid']))
+        refuri = node.get('refuri')
+        if refuri and refuri.startswith('%'):
+            # see DocxBuilder.get_target_uri
+            docname, sep, anchor = refuri[1:].partition('#')
+            return self.bookmarks.get((docname, anchor))
+        return None
+
+    def _docname_of(self, node):
+        # type: (nodes.Node) -> unicode
+        """Return the name of the document which *node* will be translated in."""
+        parent = node.parent
+        while parent is not None:
+            if isinstance(parent, addnodes.start_of_file):
+                return parent['docname']
+            parent = parent.parent
+        return self.docnames[-1]
 
     def depart_reference(self, node):
         # type: (nodes.Node) -> None
+        if self.hyperlink is not None:
+            self._flush_run()
+            self.hyperlink = None
         self.r_style = None
 
     def visit_number_reference(self, node):
         # type: (nodes.Node) -> None
         text = node.children[0].astext()
-        self.r = self.p.add_run(text, style=self.r_style)
+        self._add_run(text, style=self.r_style)
         raise nodes.SkipNode
 
     def visit_download_reference(self, node):
@@ -1103,7 +1932,7 @@ class DocxTranslator(nodes.NodeVisitor):
         # type: (nodes.Node) -> None
         text = node.astext()
         #text = nodes.Text(node.get('title', '#'))
-        self.r = self.p.add_run('[%s]' % (text), style=self.stylename['footnote_reference'])
+        self._add_run('[%s]' % (text), style=self.stylename['footnote_reference'])
         raise nodes.SkipNode
 
     def visit_citation_reference(self, node):
@@ -1121,7 +1950,7 @@ class DocxTranslator(nodes.NodeVisitor):
                 text = node.astext().replace('\n\n', '\n')
             else:
                 text = node.astext().replace('\n', ' ')
-            self.r = self._add_run(text, style=self.r_style)
+            self._add_run(text, style=self.r_style)
 
     def depart_Text(self, node):
         # type: (nodes.Node) -> None
@@ -1179,11 +2008,17 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def visit_math(self, node):
         # type: (nodes.Node) -> None
-        # TODO: support to convert from latex to docx
         eq = node.get('latex')
         text = eq if eq else node.astext()
-        self.r = self._add_run(text, style=self.r_style)
-        self.r = None
+        omath = self.builder.math_converter.get(text, node) if self.p else None
+        if omath is None:
+            self._add_run(text, style=self.r_style)
+        else:
+            self._flush_run()
+            if self.hyperlink is not None and self.hyperlink.getparent() is self.p._p:
+                self.hyperlink.append(omath)
+            else:
+                self.p._p.append(omath)
         raise nodes.SkipNode
 
     def visit_math_block(self, node):
@@ -1201,13 +2036,21 @@ class DocxTranslator(nodes.NodeVisitor):
         number = node.get('number')
         number = '(%s)' % str(number) if number else ''
         self._add_paragraph_between_table(node)
-        table = self.p_parents[-1].add_table(rows=1, cols=3)
+        parent = self.p_parents[-1]
+        if parent is self.docx:
+            table = parent._body.add_table(1, 3, self.block_width)
+        else:
+            table = parent.add_table(rows=1, cols=3)
         twidth = sum([cell.width for cell in table.row_cells(0)])
         table.cell(0, 0).width = int(twidth * 0.1)
         table.cell(0, 0).text = ''
         table.cell(0, 0).paragraphs[0].alignment = WD_TABLE_ALIGNMENT.LEFT
         table.cell(0, 1).width = int(twidth * 0.8)
-        table.cell(0, 1).text = eq
+        omath = self.builder.math_converter.get(display_latex(eq), node)
+        if omath is None:
+            table.cell(0, 1).text = eq
+        else:
+            table.cell(0, 1).paragraphs[0]._p.append(math_paragraph(omath))
         table.cell(0, 1).paragraphs[0].alignment = WD_TABLE_ALIGNMENT.CENTER
         table.cell(0, 2).width = int(twidth * 0.1)
         table.cell(0, 2).text = number
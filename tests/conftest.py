@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+    Fixtures for building small Sphinx projects with the docx builder.
+
+    :copyright: Copyright 2018 by nakandev.
+    :license: MIT, see LICENSE for details.
+"""
+
+import io
+import os
+import sys
+
+import pytest
+
+from sphinx.cmd.build import build_main
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+CONF = u"""\
+extensions = ['sphinxpapyrus.docxbuilder']
+master_doc = 'index'
+project = 'Test'
+"""
+
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true',
+                     help='run the slow scaling benchmarks too')
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: slow scaling benchmark, '
+                            'run with --benchmark')
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+    skip = pytest.mark.skip(reason='needs --benchmark')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+@pytest.fixture
+def project(tmpdir):
+    """Return a function which writes *files*, a dict of file names and
+    contents, into the new source directory *name* and returns its path.
+    ``conf.py`` gets the extension and *conf* appended."""
+    def make(files, conf=u'', name='src'):
+        srcdir = tmpdir.mkdir(name)
+        for name, content in dict(files, **{'conf.py': CONF + conf}).items():
+            srcdir.join(name).dirpath().ensure(dir=True)
+            with io.open(str(srcdir.join(name)), 'w', encoding='utf-8') as f:
+                f.write(content)
+        return str(srcdir)
+    return make
+
+@pytest.fixture
+def build(tmpdir):
+    """Return a function which builds *srcdir* into the new output directory
+    *name* with the extra sphinx-build *args* and returns its path."""
+    def run(srcdir, name, *args):
+        outdir = str(tmpdir.join(name))
+        status = build_main(['-q', '-E', '-b', 'docx', '-d', os.path.join(outdir, '.doctrees')]
+                            + list(args) + [srcdir, outdir])
+        assert status == 0
+        return outdir
+    return run
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+    The python-docx and lxml backends give the same document.
+
+    :copyright: Copyright 2018 by nakandev.
+    :license: MIT, see LICENSE for details.
+"""
+
+import os
+import zipfile
+
+import pytest
+
+FILES = {
+    'index.rst': u"""\
+Index
+=====
+
+.. |tab| unicode:: U+0009
+
+Tabs|tab|between|tab|words and a trailing tab |tab|
+
+Leading and *trailing* spaces around **strong** and ``literal`` text.
+
+| A line block
+|     with indented
+| lines
+
+::
+
+    literal block
+    	with a tab
+      and leading spaces
+
+.. parsed-literal::
+
+   parsed *literal*
+      with newlines
+
+* bullet
+
+  * nested bullet
+
+    #. nested enumeration
+    #. second
+
+* second bullet
+
+#. enumerated
+#. second
+
++-----------------------+------------------+
+| Header                | Header           |
++=======================+==================+
+| First paragraph.      | * list in a cell |
+|                       | * second         |
+| Second |tab| one.     |                  |
++-----------------------+------------------+
+| ::                    | Plain            |
+|                       |                  |
+|    literal in a cell  |                  |
+|      indented         |                  |
++-----------------------+------------------+
+
+term
+   Definition with *emphasis*.
+
+Non-ASCII: Ünïcödé, 日本語のテキスト and :math:`\\sum_{i=1}^n \\alpha_i`.
+
+.. math::
+
+   \\int_0^\\infty e^{-x} \\, dx = 1
+""",
+}
+
+CONF = u"""
+docx_highlight_max_size = 0
+docx_fragment_cache = False
+"""
+
+def document_xml(outdir):
+    with zipfile.ZipFile(os.path.join(outdir, 'Test.docx')) as docx:
+        return docx.read('word/document.xml')
+
+def test_streaming_is_equivalent(project, build):
+    srcdir = project(FILES, CONF)
+    streamed = build(srcdir, 'streamed', '-D', 'docx_streaming=1')
+    in_memory = build(srcdir, 'in-memory', '-D', 'docx_streaming=0')
+    xml = document_xml(in_memory)
+    for text in (u'日本語のテキスト', u'∑', u'∫'):
+        assert text.encode('utf-8') in xml, text
+    assert document_xml(streamed) == xml
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_backends_are_equivalent(project, build, streaming):
+    srcdir = project(FILES, CONF)
+    options = ['-D', 'docx_streaming=%d' % streaming]
+    lxml = build(srcdir, 'lxml', '-D', 'docx_backend=lxml', *options)
+    python_docx = build(srcdir, 'python-docx', '-D', 'docx_backend=python-docx', *options)
+    xml = document_xml(lxml)
+    for tag in (b'<w:tab/>', b'<w:br/>', b'xml:space="preserve"', b'<w:numPr>',
+                b'<w:tc>'):
+        assert tag in xml, tag
+    assert document_xml(python_docx) == xml
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+    Scaling benchmarks: builds at two sizes whose times must grow about
+    linearly. They are slow, so they only run with ``pytest --benchmark``.
+
+    :copyright: Copyright 2018 by nakandev.
+    :license: MIT, see LICENSE for details.
+"""
+
+import re
+import time
+import zipfile
+
+import pytest
+
+from sphinxpapyrus.docxbuilder.builder import DocxBuilder
+
+pytestmark = pytest.mark.benchmark
+
+# a build 4 times as large may take at most this many times as long;
+# linear code gives about 4, quadratic code about 16
+MAX_RATIO = 8
+
+# python-docx scans the body for every paragraph it appends, which is
+# quadratic by itself; the lxml backend appends in constant time
+CONF = u"""\
+docx_backend = 'lxml'
+"""
+
+@pytest.fixture
+def write_time(project, build, monkeypatch):
+    """Return a function which builds *files* and returns the time spent in
+    the write phase, leaving out reading, which is up to docutils."""
+    write = DocxBuilder.write
+    times = []
+    def timed_write(self, *args, **kwargs):
+        start = time.time()
+        write(self, *args, **kwargs)
+        times.append(time.time() - start)
+    monkeypatch.setattr(DocxBuilder, 'write', timed_write)
+    def run(name, files, conf=u''):
+        build(project(files, CONF + conf, name=name + '-src'), name)
+        return times.pop()
+    return run
+
+def assert_linear(write_time, make_files, size, conf=u''):
+    """Build the files of *make_files(size)* and of 4 times *size* and
+    check that the write time grows about linearly."""
+    write_time('warmup', make_files(10), conf)
+    small = write_time('small', make_files(size), conf)
+    large = write_time('large', make_files(4 * size), conf)
+    print('%d: %.2fs, %d: %.2fs' % (size, small, 4 * size, large))
+    assert large < MAX_RATIO * small
+
+def sections(count):
+    body = u''.join(u'Section %06d\n==============\n\nText of section %d.\n\n'
+                    % (i, i) for i in range(count))
+    return {'index.rst': u'Index\n*****\n\n' + body}
+
+def test_pagebreaks(write_time):
+    assert_linear(write_time, sections, 2000,
+                  u'docx_pagebreak_level = 1\n')
+
+def field_list(count):
+    fields = u''.join(u':field %d: Body of field %d.\n' % (i, i)
+                      for i in range(count))
+    return {'index.rst': u'Index\n*****\n\n' + fields}
+
+def test_field_list(write_time):
+    assert_linear(write_time, field_list, 2500)
+
+def references(count):
+    sections = []
+    for i in range(100):
+        refs = [u':ref:`label-%d`' % ((i + j) % 100) for j in range(count // 100)]
+        lines = u''.join(u' '.join(refs[k:k + 10]) + u'\n\n'
+                         for k in range(0, len(refs), 10))
+        sections.append(u'.. _label-%d:\n\nSection %03d\n===========\n\n%s'
+                        % (i, i, lines))
+    return {'index.rst': u'Index\n*****\n\n' + u''.join(sections)}
+
+def test_references(write_time, tmpdir):
+    assert_linear(write_time, references, 25000)
+    with zipfile.ZipFile(str(tmpdir.join('large', 'Test.docx'))) as docx:
+        xml = docx.read('word/document.xml').decode('utf-8')
+    bookmarks = set(re.findall(r'<w:bookmarkStart [^>]*w:name="([^"]+)"', xml))
+    anchors = re.findall(r'<w:hyperlink [^>]*w:anchor="([^"]+)"', xml)
+    assert len(anchors) == 100000
+    assert set(anchors) <= bookmarks
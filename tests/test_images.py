@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+    Images embedded in the document.
+
+    :copyright: Copyright 2018 by nakandev.
+    :license: MIT, see LICENSE for details.
+"""
+
+import os
+import zipfile
+
+import pytest
+
+FORMATS = ('png', 'gif', 'jpeg', 'jpg', 'bmp', 'tiff', 'tif')
+
+def test_raster_images_are_embedded(project, build):
+    PILImage = pytest.importorskip('PIL.Image')
+    srcdir = project({'index.rst': u'Index\n=====\n\n' + u''.join(
+        u'.. image:: image.%s\n\n' % ext for ext in FORMATS)})
+    for ext in FORMATS:
+        fmt = {'jpg': 'jpeg', 'tif': 'tiff'}.get(ext, ext)
+        PILImage.new('RGB', (16, 8), (255, 0, 0)).save(
+            os.path.join(srcdir, 'image.' + ext), fmt.upper())
+    outdir = build(srcdir, 'out')
+    with zipfile.ZipFile(os.path.join(outdir, 'Test.docx')) as docx:
+        xml = docx.read('word/document.xml')
+        media = [name for name in docx.namelist() if name.startswith('word/media/')]
+    assert xml.count(b'<pic:pic') == len(FORMATS)
+    assert set(['.bmp', '.tiff']) <= set(os.path.splitext(name)[1] for name in media)
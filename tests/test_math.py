@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+    LaTeX math converted to Office Math.
+
+    :copyright: Copyright 2018 by nakandev.
+    :license: MIT, see LICENSE for details.
+"""
+
+import os
+import zipfile
+
+from sphinxpapyrus.docxbuilder.omml import display_latex, latex_to_omml
+
+FILES = {
+    'index.rst': u"""\
+Index
+=====
+
+.. math::
+
+   E = mc^2 % energy
+
+   F = ma
+""",
+}
+
+def text_of(element):
+    return u''.join(element.itertext())
+
+def test_comments_do_not_swallow_the_next_equation():
+    latex = display_latex(u'E = mc^2 % energy\n\nF = ma')
+    assert u'energy' not in latex
+    text = text_of(latex_to_omml(latex))
+    assert u'E=m' in text and u'F=ma' in text
+
+def test_escaped_percent_is_kept():
+    latex = display_latex(u'x = 5\\% % rate\n\ny')
+    assert u'5\\%' in latex
+    assert u'rate' not in latex
+
+def test_multi_equation_block(project, build):
+    outdir = build(project(FILES), 'out')
+    with zipfile.ZipFile(os.path.join(outdir, 'Test.docx')) as docx:
+        xml = docx.read('word/document.xml').decode('utf-8')
+    assert u'<m:oMath' in xml
+    assert u'energy' not in xml
+    assert u'F=ma' in xml
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+    Entries written by parallel worker processes.
+
+    :copyright: Copyright 2018 by nakandev.
+    :license: MIT, see LICENSE for details.
+"""
+
+import os
+
+import pytest
+
+FILES = {
+    'index.rst': u"""\
+Index
+=====
+
+.. toctree::
+
+   chapter1
+   chapter2
+""",
+    'chapter1.rst': u"""\
+.. _chapter1:
+
+Chapter 1
+=========
+
+Some *emphasis* and **strong** text, see :ref:`chapter2`.
+
+* item
+* item
+
+  #. nested
+""",
+    'chapter2.rst': u"""\
+.. _chapter2:
+
+Chapter 2
+=========
+
+A `link <https://example.com/>`_ and :ref:`chapter1`.
+
+::
+
+   literal
+       block
+""",
+}
+
+CONF = u"""
+docx_reproducible = True
+docx_documents = [
+    ('index', 'all', {'title': 'All'}),
+    ('chapter1', 'chapter1', {'title': 'Chapter 1'}),
+    ('chapter2', 'chapter2', {'title': 'Chapter 2'}),
+]
+"""
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='parallel builds need fork()')
+def test_parallel_output_is_identical(project, build, monkeypatch):
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', '1500000000')
+    srcdir = project(FILES, CONF)
+    serial = build(srcdir, 'serial')
+    parallel = build(srcdir, 'parallel', '-j', '2')
+    for name in ('all.docx', 'chapter1.docx', 'chapter2.docx'):
+        with open(os.path.join(serial, name), 'rb') as f:
+            expected = f.read()
+        with open(os.path.join(parallel, name), 'rb') as f:
+            assert f.read() == expected, name
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+    Internal cross-references written as hyperlinks to bookmarks.
+
+    :copyright: Copyright 2018 by nakandev.
+    :license: MIT, see LICENSE for details.
+"""
+
+import os
+import re
+import zipfile
+
+FILES = {
+    'index.rst': u"""\
+.. _top:
+
+Index
+=====
+
+.. toctree::
+
+   sub/chapter
+
+See :ref:`chapter`.
+""",
+    'sub/chapter.rst': u"""\
+.. _chapter:
+
+Chapter
+=======
+
+Back to :ref:`top`, to :ref:`chapter` and to :doc:`../index`.
+""",
+}
+
+def test_references_from_a_subdirectory(project, build):
+    outdir = build(project(FILES), 'out')
+    with zipfile.ZipFile(os.path.join(outdir, 'Test.docx')) as docx:
+        xml = docx.read('word/document.xml').decode('utf-8')
+    bookmarks = set(re.findall(r'<w:bookmarkStart [^>]*w:name="([^"]+)"', xml))
+    anchors = re.findall(r'<w:hyperlink [^>]*w:anchor="([^"]+)"', xml)
+    assert len(anchors) == 4
+    assert set(anchors) <= bookmarks